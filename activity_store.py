@@ -0,0 +1,326 @@
+import os
+import json
+import sqlite3
+from activity_summary import SUMMARY_SCHEMA, fold_summary, rebuild_summary
+
+# SQLite-backed activity store. Each activity keeps its full Strava payload in
+# `data`, plus the handful of columns the pipeline filters and aggregates on,
+# so new activities are inserted in O(new) and readers never parse the lot.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY,
+    start_date TEXT,
+    start_date_local TEXT,
+    gear_id TEXT,
+    sport_type TEXT,
+    distance REAL,
+    moving_time INTEGER,
+    total_elevation_gain REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_activities_gear_id ON activities(gear_id);
+CREATE INDEX IF NOT EXISTS idx_activities_start_date_local ON activities(start_date_local);
+CREATE TABLE IF NOT EXISTS gear_totals (
+    gear_id TEXT PRIMARY KEY,
+    activity_count INTEGER,
+    total_distance REAL,
+    total_elevation_gain REAL,
+    total_time INTEGER,
+    longest REAL,
+    first_use TEXT
+);
+"""
+
+# Bumped when a derived table needs rebuilding from the activities
+SCHEMA_VERSION = 2
+
+COLUMNS = ["id", "start_date", "start_date_local", "gear_id", "sport_type",
+           "distance", "moving_time", "total_elevation_gain"]
+
+SQLITE_MAX_VARIABLES = 900
+JSON_CHUNK_SIZE = 1 << 16
+MIGRATION_BATCH_SIZE = 1000
+
+def legacy_json_path(db_path):
+    return os.path.splitext(db_path)[0] + ".json"
+
+def open_store(db_path):
+    # Creates the store on first use, migrating a sibling activities.json once
+    json_path = legacy_json_path(db_path)
+    if not os.path.exists(db_path) and os.path.exists(json_path):
+        migrate_legacy_json(json_path, db_path)
+    return connect_store(db_path)
+
+def connect_store(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA + SUMMARY_SCHEMA)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        rebuild_gear_totals(conn)
+        rebuild_summary(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return conn
+
+def migrate_legacy_json(json_path, db_path):
+    # Builds the store next to db_path and only renames it into place after
+    # the last batch, so an interrupted migration is redone on the next run
+    # instead of leaving a partial store that looks migrated
+    tmp_path = db_path + ".tmp"
+    for stale in (tmp_path, tmp_path + "-wal", tmp_path + "-shm"):
+        if os.path.exists(stale):
+            os.remove(stale)
+    conn = connect_store(tmp_path)
+    try:
+        migrated = 0
+        batch = []
+        for activity in iter_json_array(json_path):
+            batch.append(activity)
+            if len(batch) == MIGRATION_BATCH_SIZE:
+                migrated += insert_activities(conn, batch)
+                batch = []
+        migrated += insert_activities(conn, batch)
+    finally:
+        # Closing checkpoints the WAL into the file before it is moved
+        conn.close()
+    os.replace(tmp_path, db_path)
+    print(f"Migrated {migrated} activities from {json_path} to {db_path}")
+
+def iter_json_array(path, chunk_size=JSON_CHUNK_SIZE):
+    # Yields the objects of a top-level JSON array one at a time, reading the
+    # file in chunks, so a large activities.json is never held in memory whole
+    decoder = json.JSONDecoder()
+    with open(path, "r") as f:
+        buf = f.read(chunk_size).lstrip()
+        if not buf:
+            return
+        if buf[0] != "[":
+            raise ValueError(f"{path} does not contain a JSON array")
+        pos = 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                buf, pos = f.read(chunk_size), 0
+                if not buf:
+                    raise ValueError(f"{path}: unexpected end of JSON array")
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Object runs past the end of the buffer: read more and retry
+                more = f.read(chunk_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield obj
+            pos = end
+
+def activity_columns(activity):
+    # Values for COLUMNS, in order
+    return (
+        activity["id"],
+        activity.get("start_date"),
+        activity.get("start_date_local"),
+        activity.get("gear_id"),
+        activity.get("sport_type", activity.get("type")),
+        activity.get("distance", 0),
+        activity.get("moving_time", 0),
+        activity.get("total_elevation_gain", 0),
+    )
+
+def activity_row(activity):
+    return activity_columns(activity) + (json.dumps(activity),)
+
+def stored_rows(conn, ids):
+    # {id: row dict of COLUMNS} for the given activity IDs that are stored
+    found = {}
+    ids = list(ids)
+    for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+        chunk = ids[i:i + SQLITE_MAX_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM activities WHERE id IN ({placeholders})", chunk):
+            found[row[0]] = dict(zip(COLUMNS, row))
+    return found
+
+def insert_activities(conn, activities):
+    # Upsert on the primary key and keep gear_totals and the summary cube in
+    # step; returns how many activities were new
+    rows = {a["id"]: activity_row(a) for a in activities}
+    with conn:
+        # Take the write lock before looking up what is stored, so another
+        # writer (the webhook or a polling run) can't fold the same activity
+        conn.execute("BEGIN IMMEDIATE")
+        already_stored = stored_rows(conn, rows)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO activities ({', '.join(COLUMNS)}, data) "
+            f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})",
+            rows.values()
+        )
+        row_dicts = {aid: dict(zip(COLUMNS, row)) for aid, row in rows.items()}
+        new_rows = [row for aid, row in row_dicts.items() if aid not in already_stored]
+        fold_gear_totals(conn, aggregate_activity_rows(new_rows))
+        # A replaced activity may have changed distance or gear; its old
+        # values can't be subtracted from a max/min, so recompute that gear
+        changed_gear = {row["gear_id"] for row in already_stored.values()}
+        changed_gear.update(row_dicts[aid]["gear_id"] for aid in already_stored)
+        recompute_gear_totals(conn, {g for g in changed_gear if g})
+        # The cube only holds sums, so replaced activities are swapped out
+        fold_summary(conn, already_stored.values(), sign=-1)
+        fold_summary(conn, row_dicts.values())
+    return len(rows) - len(already_stored)
+
+def delete_activities(conn, ids):
+    # Removes activities and takes them back out of gear_totals and the
+    # summary cube; returns how many were stored
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        old_rows = stored_rows(conn, ids)
+        conn.executemany("DELETE FROM activities WHERE id = ?", [(aid,) for aid in old_rows])
+        recompute_gear_totals(conn, {row["gear_id"] for row in old_rows.values() if row["gear_id"]})
+        fold_summary(conn, old_rows.values(), sign=-1)
+    return len(old_rows)
+
+def count_activities(conn):
+    return conn.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
+
+def latest_activity(conn):
+    # (id, start_date) of the most recent activity by UTC start, or None
+    return conn.execute(
+        "SELECT id, start_date FROM activities ORDER BY start_date DESC LIMIT 1").fetchone()
+
+def distinct_gear_ids(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT DISTINCT gear_id FROM activities WHERE gear_id IS NOT NULL")]
+
+def iter_activity_rows(activities_path, columns, gear_ids=None):
+    # Yields activities as dicts holding only `columns`, optionally limited
+    # to the given gear. Reads the SQLite store, or streams a legacy
+    # activities.json, in near-constant memory either way.
+    if activities_path.endswith(".json"):
+        if gear_ids is not None:
+            gear_ids = set(gear_ids)
+        for activity in iter_json_array(activities_path):
+            if gear_ids is None or activity.get("gear_id") in gear_ids:
+                row = dict(zip(COLUMNS, activity_columns(activity)))
+                yield {c: row[c] for c in columns}
+        return
+
+    conn = open_store(activities_path)
+    try:
+        query, params = gear_ids_clause(f"SELECT {', '.join(columns)} FROM activities", gear_ids, "WHERE")
+        for row in conn.execute(query, params):
+            yield dict(zip(columns, row))
+    finally:
+        conn.close()
+
+GEAR_TOTAL_FIELDS = ["activity_count", "total_distance", "total_elevation_gain",
+                     "total_time", "longest", "first_use"]
+
+def empty_gear_totals():
+    return {"activity_count": 0, "total_distance": 0, "total_elevation_gain": 0,
+            "total_time": 0, "longest": 0, "first_use": None}
+
+def gear_ids_clause(query, gear_ids, joiner):
+    if gear_ids is None:
+        return query, []
+    params = list(gear_ids)
+    return query + f" {joiner} gear_id IN ({','.join('?' * len(params))})", params
+
+def compute_gear_totals(conn, gear_ids=None):
+    # Every per-gear metric in one grouped pass over the indexed columns.
+    # first_use is the earliest start date as an ISO string.
+    query, params = gear_ids_clause(
+        "SELECT gear_id, COUNT(*), SUM(distance), SUM(total_elevation_gain), SUM(moving_time), "
+        "MAX(distance), MIN(COALESCE(start_date_local, start_date)) "
+        "FROM activities WHERE gear_id IS NOT NULL",
+        gear_ids, "AND"
+    )
+    query += " GROUP BY gear_id"
+    return {row[0]: dict(zip(GEAR_TOTAL_FIELDS, row[1:])) for row in conn.execute(query, params)}
+
+def stored_gear_totals(conn, gear_ids=None):
+    # The running aggregates kept up to date by insert_activities
+    query, params = gear_ids_clause(
+        f"SELECT gear_id, {', '.join(GEAR_TOTAL_FIELDS)} FROM gear_totals", gear_ids, "WHERE")
+    return {row[0]: dict(zip(GEAR_TOTAL_FIELDS, row[1:])) for row in conn.execute(query, params)}
+
+def fold_gear_totals(conn, totals):
+    # Add per-gear totals for new activities into the running aggregates
+    conn.executemany(
+        f"INSERT INTO gear_totals (gear_id, {', '.join(GEAR_TOTAL_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(gear_id) DO UPDATE SET "
+        "activity_count = activity_count + excluded.activity_count, "
+        "total_distance = total_distance + excluded.total_distance, "
+        "total_elevation_gain = total_elevation_gain + excluded.total_elevation_gain, "
+        "total_time = total_time + excluded.total_time, "
+        "longest = MAX(longest, excluded.longest), "
+        "first_use = MIN(COALESCE(first_use, excluded.first_use), COALESCE(excluded.first_use, first_use))",
+        [(gear_id, *(t[f] for f in GEAR_TOTAL_FIELDS)) for gear_id, t in totals.items()]
+    )
+
+def recompute_gear_totals(conn, gear_ids):
+    if not gear_ids:
+        return
+    query, params = gear_ids_clause("DELETE FROM gear_totals", gear_ids, "WHERE")
+    conn.execute(query, params)
+    fold_gear_totals(conn, compute_gear_totals(conn, gear_ids))
+
+def rebuild_gear_totals(conn):
+    with conn:
+        conn.execute("DELETE FROM gear_totals")
+        fold_gear_totals(conn, compute_gear_totals(conn))
+
+def verify_gear_totals(conn, tolerance=1e-6):
+    # Compare the running aggregates with a fresh build; returns mismatches
+    # as (gear_id, field, stored, expected)
+    stored = stored_gear_totals(conn)
+    expected = compute_gear_totals(conn)
+    mismatches = []
+    for gear_id in sorted(set(stored) | set(expected)):
+        s = stored.get(gear_id) or empty_gear_totals()
+        e = expected.get(gear_id) or empty_gear_totals()
+        for field in GEAR_TOTAL_FIELDS:
+            if isinstance(e[field], float) or isinstance(s[field], float):
+                same = abs((s[field] or 0) - (e[field] or 0)) <= tolerance * max(1, abs(e[field] or 0))
+            else:
+                same = s[field] == e[field]
+            if not same:
+                mismatches.append((gear_id, field, s[field], e[field]))
+    return mismatches
+
+def aggregate_activity_rows(rows):
+    # Same result as gear_totals, for rows read from a legacy activities.json
+    totals = {}
+    for row in rows:
+        gear_id = row["gear_id"]
+        if not gear_id:
+            continue
+        t = totals.setdefault(gear_id, empty_gear_totals())
+        t["activity_count"] += 1
+        t["total_distance"] += row["distance"]
+        t["total_elevation_gain"] += row["total_elevation_gain"]
+        t["total_time"] += row["moving_time"]
+        t["longest"] = max(t["longest"], row["distance"])
+        date_str = row["start_date_local"] or row["start_date"]
+        if date_str and (t["first_use"] is None or date_str < t["first_use"]):
+            t["first_use"] = date_str
+    return totals
+
+def load_gear_totals(activities_path, gear_ids=None):
+    if activities_path.endswith(".json"):
+        rows = iter_activity_rows(
+            activities_path,
+            ["gear_id", "distance", "total_elevation_gain", "moving_time", "start_date", "start_date_local"],
+            gear_ids=gear_ids
+        )
+        return aggregate_activity_rows(rows)
+    conn = open_store(activities_path)
+    try:
+        return stored_gear_totals(conn, gear_ids)
+    finally:
+        conn.close()
@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from strava_tools import api_get, make_session, StravaClient, StravaAPIError
+from activity_store import open_store
+
+# Per-second activity streams from /activities/{id}/streams, stored as typed
+# NumPy arrays rather than JSON: streams/<activity_id>/<key>.npy plus a
+# meta.json written last as the "complete" marker. Each array uses the
+# narrowest dtype that holds the data (heart rate fits in a uint8, lat/lng in
+# int32 1e-7 degrees), and is memory-mapped on read, so slicing a time range
+# only touches the pages it needs. NumPy is only needed for this module.
+#   python activity_streams.py --limit 200
+#
+# Streams cost one API call per activity, so fetching is newest first and
+# resumable: activities with a meta.json are skipped.
+
+STREAM_KEYS = ["time", "distance", "latlng", "altitude", "velocity_smooth", "heartrate",
+               "cadence", "watts", "temp", "moving", "grade_smooth"]
+
+# key: (dtype, scale) -- stored = round(value * scale) for integer dtypes
+STREAM_DTYPES = {
+    "time": ("uint32", 1),
+    "distance": ("float32", 1),
+    "latlng": ("int32", 10 ** 7),
+    "altitude": ("float32", 1),
+    "velocity_smooth": ("float32", 1),
+    "heartrate": ("uint8", 1),
+    "cadence": ("uint8", 1),
+    "watts": ("uint16", 1),
+    "temp": ("int8", 1),
+    "moving": ("bool", 1),
+    "grade_smooth": ("float32", 1),
+}
+
+STREAM_WORKERS = 4
+
+def activity_stream_dir(streams_dir, activity_id):
+    return os.path.join(streams_dir, str(activity_id))
+
+def has_streams(streams_dir, activity_id):
+    return os.path.exists(os.path.join(activity_stream_dir(streams_dir, activity_id), "meta.json"))
+
+def encode_stream(key, data):
+    import numpy as np
+    dtype, scale = STREAM_DTYPES.get(key, ("float32", 1))
+    values = np.asarray([v if v is not None else 0 for v in data] if key != "latlng" else data,
+                        dtype="float64")
+    if scale != 1:
+        values = np.round(values * scale)
+    if np.dtype(dtype).kind in "ui":
+        info = np.iinfo(dtype)
+        values = np.clip(np.round(values), info.min, info.max)
+    return values.astype(dtype)
+
+def save_streams(streams_dir, activity_id, streams):
+    # streams is Strava's key_by_type response: {key: {"data": [...], ...}}
+    import numpy as np
+    final_dir = activity_stream_dir(streams_dir, activity_id)
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    meta = {"keys": [], "original_size": None, "resolution": None}
+    for key, stream in streams.items():
+        if key not in STREAM_DTYPES or not stream.get("data"):
+            continue
+        np.save(os.path.join(tmp_dir, f"{key}.npy"), encode_stream(key, stream["data"]))
+        meta["keys"].append(key)
+        meta["original_size"] = stream.get("original_size", meta["original_size"])
+        meta["resolution"] = stream.get("resolution", meta["resolution"])
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+
+def fetch_streams(db_path, streams_dir, limit=None, max_workers=STREAM_WORKERS, client=None):
+    # Download streams for stored activities that don't have them yet
+    conn = open_store(db_path)
+    ids = [row[0] for row in conn.execute("SELECT id FROM activities ORDER BY start_date DESC")]
+    conn.close()
+    to_fetch = [aid for aid in ids if not has_streams(streams_dir, aid)]
+    stored = len(ids) - len(to_fetch)
+    if limit is not None:
+        to_fetch = to_fetch[:limit]
+    os.makedirs(streams_dir, exist_ok=True)
+
+    params = {"keys": ",".join(STREAM_KEYS), "key_by_type": "true"}
+    fetched = 0
+    max_workers = max(1, min(max_workers, len(to_fetch)))
+    with make_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def fetch_one(aid):
+            try:
+                streams = api_get(f"/activities/{aid}/streams", params=params, session=session, client=client)
+            except StravaAPIError as e:
+                # Manual activities have no streams; record that so they're skipped next time
+                if e.status_code != 404:
+                    raise
+                streams = {}
+            save_streams(streams_dir, aid, streams if isinstance(streams, dict) else {})
+
+        futures = {executor.submit(fetch_one, aid): aid for aid in to_fetch}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                fetched += 1
+            except Exception:
+                for pending in futures:
+                    pending.cancel()
+                raise
+    print(f"Fetched streams for {fetched} activities ({stored} already stored).")
+    return fetched
+
+def stream_keys(streams_dir, activity_id):
+    with open(os.path.join(activity_stream_dir(streams_dir, activity_id), "meta.json"), "r") as f:
+        return json.load(f)["keys"]
+
+def load_stream(streams_dir, activity_id, key):
+    # Memory-mapped raw array in its stored dtype (latlng in 1e-7 degrees)
+    import numpy as np
+    return np.load(os.path.join(activity_stream_dir(streams_dir, activity_id), f"{key}.npy"), mmap_mode="r")
+
+def decode_stream(key, values):
+    _, scale = STREAM_DTYPES.get(key, ("float32", 1))
+    return values / scale if scale != 1 else values
+
+def stream_slice(streams_dir, activity_id, key, start_s=None, end_s=None):
+    # Values of `key` between start_s and end_s seconds into the activity.
+    # The time stream is searched in place, so only the slice is read.
+    import numpy as np
+    times = load_stream(streams_dir, activity_id, "time")
+    lo = 0 if start_s is None else int(np.searchsorted(times, start_s, side="left"))
+    hi = len(times) if end_s is None else int(np.searchsorted(times, end_s, side="right"))
+    values = load_stream(streams_dir, activity_id, key)[lo:hi]
+    return np.asarray(times[lo:hi]), decode_stream(key, np.asarray(values))
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Download per-second activity streams")
+    parser.add_argument("--db", default=os.path.join(script_dir, "activities.db"))
+    parser.add_argument("--streams-dir", default=os.path.join(script_dir, "streams"))
+    parser.add_argument("--limit", type=int, help="fetch at most this many activities (newest first)")
+    parser.add_argument("--workers", type=int, default=STREAM_WORKERS)
+    args = parser.parse_args()
+
+    client = StravaClient.from_env(os.path.join(script_dir, ".env"))
+    fetch_streams(args.db, args.streams_dir, args.limit, args.workers, client)
@@ -0,0 +1,114 @@
+import argparse
+
+# Year/month rollup of activities by sport type and gear, kept in the activity
+# store and updated by insert_activities as activities arrive. Queries such as
+# "running km per month in 2024" read a few hundred cube rows, not the history.
+#   python activity_summary.py --year 2024 --sport Run
+
+SUMMARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity_summary (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    sport_type TEXT NOT NULL,
+    gear_id TEXT NOT NULL,
+    activity_count INTEGER NOT NULL,
+    distance REAL NOT NULL,
+    moving_time INTEGER NOT NULL,
+    elevation_gain REAL NOT NULL,
+    PRIMARY KEY (year, month, sport_type, gear_id)
+) WITHOUT ROWID;
+"""
+
+SUMMARY_FIELDS = ["activity_count", "distance", "moving_time", "elevation_gain"]
+DIMENSIONS = ["year", "month", "sport_type", "gear_id"]
+
+def summary_key(row):
+    # Calendar month of the local start time; activities without gear or
+    # sport type are kept under '' so they still count towards the totals
+    date_str = row["start_date_local"] or row["start_date"] or ""
+    try:
+        year, month = int(date_str[:4]), int(date_str[5:7])
+    except ValueError:
+        year, month = 0, 0
+    return (year, month, row["sport_type"] or "", row["gear_id"] or "")
+
+def rollup(rows, sign=1):
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault(summary_key(row), [0, 0, 0, 0])
+        cell[0] += sign
+        cell[1] += sign * row["distance"]
+        cell[2] += sign * row["moving_time"]
+        cell[3] += sign * row["total_elevation_gain"]
+    return cells
+
+def fold_summary(conn, rows, sign=1):
+    # Add (or with sign=-1, remove) activity rows from the cube
+    conn.executemany(
+        f"INSERT INTO activity_summary ({', '.join(DIMENSIONS + SUMMARY_FIELDS)}) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(year, month, sport_type, gear_id) DO UPDATE SET "
+        "activity_count = activity_count + excluded.activity_count, "
+        "distance = distance + excluded.distance, "
+        "moving_time = moving_time + excluded.moving_time, "
+        "elevation_gain = elevation_gain + excluded.elevation_gain",
+        [(*key, *cell) for key, cell in rollup(rows, sign).items()]
+    )
+    if sign < 0:
+        conn.execute("DELETE FROM activity_summary WHERE activity_count <= 0")
+
+def rebuild_summary(conn):
+    with conn:
+        conn.execute("DELETE FROM activity_summary")
+        conn.execute(
+            f"INSERT INTO activity_summary ({', '.join(DIMENSIONS + SUMMARY_FIELDS)}) "
+            "SELECT CAST(substr(d, 1, 4) AS INTEGER), CAST(substr(d, 6, 2) AS INTEGER), "
+            "COALESCE(sport_type, ''), COALESCE(gear_id, ''), "
+            "COUNT(*), SUM(distance), SUM(moving_time), SUM(total_elevation_gain) "
+            "FROM (SELECT *, COALESCE(start_date_local, start_date, '') AS d FROM activities) "
+            "GROUP BY 1, 2, 3, 4"
+        )
+
+def query_summary(conn, by=("year", "month"), year=None, month=None, sport_type=None, gear_id=None):
+    # Totals from the cube grouped by any of DIMENSIONS, e.g.
+    # query_summary(conn, by=("month",), year=2024, sport_type=["Run", "TrailRun"])
+    if not by or any(d not in DIMENSIONS for d in by):
+        raise ValueError(f"by must be a subset of {DIMENSIONS}")
+    filters, params = [], []
+    for column, value in (("year", year), ("month", month), ("sport_type", sport_type), ("gear_id", gear_id)):
+        if value is None:
+            continue
+        values = [value] if isinstance(value, (str, int)) else list(value)
+        filters.append(f"{column} IN ({','.join('?' * len(values))})")
+        params.extend(values)
+    query = (f"SELECT {', '.join(by)}, SUM(activity_count), SUM(distance), SUM(moving_time), "
+             f"SUM(elevation_gain) FROM activity_summary")
+    if filters:
+        query += " WHERE " + " AND ".join(filters)
+    query += f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}"
+    return [dict(zip(list(by) + SUMMARY_FIELDS, row)) for row in conn.execute(query, params)]
+
+def print_summary(rows, by):
+    print(" ".join(f"{d:>12}" for d in by) + f" {'Activities':>10} {'Dist(km)':>10} {'Time(h)':>8} {'Elev(m)':>8}")
+    print("-" * (13 * len(by) + 40))
+    for r in rows:
+        dims = " ".join(f"{str(r[d]):>12}" for d in by)
+        print(f"{dims} {r['activity_count']:10} {r['distance']/1000:10.1f} {r['moving_time']/3600:8.1f} {r['elevation_gain']:8.0f}")
+
+if __name__ == "__main__":
+    import os
+    from activity_store import open_store
+
+    parser = argparse.ArgumentParser(description="Activity totals by year and month")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "activities.db"))
+    parser.add_argument("--by", default="year,month", help=f"comma-separated subset of {','.join(DIMENSIONS)}")
+    parser.add_argument("--year", type=int)
+    parser.add_argument("--month", type=int)
+    parser.add_argument("--sport", action="append", help="sport type, may be repeated")
+    parser.add_argument("--gear")
+    args = parser.parse_args()
+
+    by = tuple(args.by.split(","))
+    conn = open_store(args.db)
+    print_summary(query_summary(conn, by, args.year, args.month, args.sport, args.gear), by)
+    conn.close()
@@ -0,0 +1,123 @@
+import os
+import json
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from strava_tools import (
+    fetch_activities, extract_gear_ids_from_activities, fetch_gear_details,
+    combine_shoes, combine_bikes, write_json_atomic, StravaClient, TokenManager
+)
+from http_cache import HttpCache
+
+# Runs the run_strava.py pipeline for many athletes in one process.
+#   python batch_strava.py roster.json --workers 8 --output athletes
+#
+# roster.json is a list of athletes, each with its own app credentials and
+# tokens; refreshed tokens are written back to it:
+#   [{"name": "sam", "client_id": "...", "client_secret": "...",
+#     "refresh_token": "...", "access_token": "...", "expires_at": 0}, ...]
+# Each athlete's files, including its HTTP response cache, go to
+# <output>/<name>/. All athletes share the strava_tools rate limiter, so the
+# pool stays within one API budget.
+
+BATCH_WORKERS = 4
+
+class Roster:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        with open(path, "r") as f:
+            self.athletes = json.load(f)
+        names = [a["name"] for a in self.athletes]
+        if len(set(names)) != len(names):
+            raise Exception("Athlete names in the roster must be unique.")
+
+    def save(self):
+        with self.lock:
+            write_json_atomic(self.path, self.athletes)
+
+class RosterTokenStore:
+    # TokenManager store backed by one athlete's roster entry
+    def __init__(self, roster, athlete):
+        self.roster = roster
+        self.athlete = athlete
+
+    def lock(self):
+        return self.roster.lock
+
+    def read(self):
+        return {k: self.athlete.get(k) for k in ("access_token", "refresh_token", "expires_at")}
+
+    def write(self, tokens):
+        with self.roster.lock:
+            self.athlete.update(tokens)
+            self.roster.save()
+
+def athlete_client(athlete, roster, cache=None):
+    # Each athlete's token state lives in its own roster entry and token
+    # manager, never in os.environ, so concurrent athletes can't see each
+    # other's tokens
+    if not athlete.get("refresh_token") and not athlete.get("access_token"):
+        raise Exception(f"No refresh token for athlete {athlete['name']}.")
+    tokens = TokenManager(
+        athlete["client_id"], athlete["client_secret"],
+        access_token=athlete.get("access_token"), refresh_token=athlete.get("refresh_token"),
+        expires_at=athlete.get("expires_at"), store=RosterTokenStore(roster, athlete)
+    )
+    return StravaClient(client_id=athlete["client_id"], client_secret=athlete["client_secret"],
+                        tokens=tokens, cache=cache)
+
+def run_athlete(athlete, roster, output_dir):
+    athlete_dir = os.path.join(output_dir, athlete["name"])
+    os.makedirs(athlete_dir, exist_ok=True)
+    activities_path = os.path.join(athlete_dir, "activities.db")
+    gear_ids_path = os.path.join(athlete_dir, "gear_ids.json")
+    all_gear_path = os.path.join(athlete_dir, "all_gear.json")
+    shoes_csv = os.path.join(athlete_dir, "shoe_league_table.csv")
+    bikes_csv = os.path.join(athlete_dir, "bike_league_table.csv")
+
+    cache = HttpCache(os.path.join(athlete_dir, "http_cache.db"))
+    try:
+        client = athlete_client(athlete, roster, cache)
+        new_activities_count = fetch_activities(activities_path, client=client)
+        if new_activities_count == 0 and os.path.exists(shoes_csv) and os.path.exists(bikes_csv):
+            return 0
+        extract_gear_ids_from_activities(activities_path, gear_ids_path)
+        fetch_gear_details(gear_ids_path, all_gear_path, client=client)
+        combine_shoes(all_gear_path, activities_path, shoes_csv)
+        combine_bikes(all_gear_path, activities_path, bikes_csv)
+        return new_activities_count
+    finally:
+        cache.close()
+
+def run_batch(roster_path, output_dir, max_workers=BATCH_WORKERS):
+    roster = Roster(roster_path)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_athlete, a, roster, output_dir): a["name"] for a in roster.athletes}
+        for future in as_completed(futures):
+            name = futures[future]
+            # One athlete failing (bad token, quota) doesn't stop the others
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+
+    print(f"\n{'Athlete':30} {'Result':>40}")
+    print("-" * 71)
+    for name in sorted(results):
+        result = results[name]
+        if isinstance(result, Exception):
+            status = f"FAILED: {result}"[:40]
+        else:
+            status = f"{result} new activities"
+        print(f"{name[:30]:30} {status:>40}")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Strava pipeline for a roster of athletes")
+    parser.add_argument("roster", help="JSON list of athlete credentials")
+    parser.add_argument("--output", default="athletes", help="directory for per-athlete output")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    args = parser.parse_args()
+    run_batch(args.roster, args.output, args.workers)
@@ -0,0 +1,448 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import strava_tools
+from activity_store import open_store
+from activity_summary import query_summary
+from http_fixtures import recording, replaying
+from pipeline_metrics import metrics
+from stub_strava import StubStrava
+from synthetic_strava import make_gear, make_activities, scale_count
+
+# Offline benchmarks for the strava_tools pipeline, run against a local stub
+# server (stub_strava.py) rather than live Strava.
+#   python bench_strava.py gear --count 300 --latency 0.05
+#   python bench_strava.py ratelimit --count 60
+#   python bench_strava.py aggregate --count 100000
+#   python bench_strava.py memory --count 100000
+#   python bench_strava.py import
+#   python bench_strava.py suite --scales 1k,10k,100k
+#
+# `suite` times every pipeline stage at each scale and appends the results to
+# bench_history.jsonl, flagging stages that got slower than their recent
+# median on the same machine.
+
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_history.jsonl")
+HISTORY_WINDOW = 5
+REGRESSION_THRESHOLD = 0.25
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def legacy_gear_stats(all_gear_path, activities_path, prefix):
+    # The aggregation loop combine_shoes/combine_bikes used to run: reload
+    # both files and parse every activity's date
+    with open(all_gear_path, "r") as f:
+        all_gear = json.load(f)
+    with open(activities_path, "r") as f:
+        activities = json.load(f)
+    stats = {g['id']: {"longest": 0, "total_distance": 0, "total_elevation_gain": 0,
+                       "activity_count": 0, "total_time": 0, "first_use": None}
+             for g in all_gear if g['id'].startswith(prefix)}
+    for activity in activities:
+        gear_id = activity.get("gear_id")
+        if gear_id in stats:
+            dist = activity.get("distance", 0)
+            date_str = activity.get("start_date_local", activity.get("start_date"))
+            try:
+                date_obj = datetime.strptime(date_str[:19], "%Y-%m-%dT%H:%M:%S")
+            except Exception:
+                date_obj = None
+            s = stats[gear_id]
+            s["total_distance"] += dist
+            s["total_elevation_gain"] += activity.get("total_elevation_gain", 0)
+            s["longest"] = max(s["longest"], dist)
+            s["activity_count"] += 1
+            s["total_time"] += activity.get("moving_time", 0)
+            if date_obj and (s["first_use"] is None or date_obj < s["first_use"]):
+                s["first_use"] = date_obj
+    return stats
+
+
+def serial_fetch_gear_details(gear_ids_path, all_gear_path):
+    # The original loop: one requests.get (and one new connection) per gear ID
+    access_token = os.environ.get('STRAVA_ACCESS_TOKEN')
+    with open(gear_ids_path, "r") as f:
+        gear_ids = json.load(f)
+    all_gear = []
+    for gid in gear_ids:
+        response = requests.get(
+            url=f'{strava_tools.STRAVA_API_URL}/gear/{gid}',
+            headers={'Authorization': f'Bearer {access_token}'}
+        )
+        all_gear.append(response.json())
+    with open(all_gear_path, "w") as f:
+        json.dump(all_gear, f, indent=2)
+
+
+def bench_gear(count, latency, workers):
+    gear = make_gear(count)
+    os.environ.setdefault('STRAVA_ACCESS_TOKEN', 'bench')
+    with StubStrava(gear=gear, latency=latency) as stub, tempfile.TemporaryDirectory() as tmp:
+        strava_tools.STRAVA_API_URL = stub.url
+        gear_ids_path = os.path.join(tmp, "gear_ids.json")
+        all_gear_path = os.path.join(tmp, "all_gear.json")
+        with open(gear_ids_path, "w") as f:
+            json.dump([g['id'] for g in gear], f)
+
+        start = time.perf_counter()
+        serial_fetch_gear_details(gear_ids_path, os.path.join(tmp, "all_gear_serial.json"))
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        strava_tools.fetch_gear_details(gear_ids_path, all_gear_path, max_workers=workers)
+        concurrent = time.perf_counter() - start
+        with open(all_gear_path) as f:
+            fetched = json.load(f)
+        assert [g['id'] for g in fetched] == sorted(g['id'] for g in gear)
+
+        # Second run is served from gear_cache.json
+        requests_before = stub.request_count
+        start = time.perf_counter()
+        strava_tools.fetch_gear_details(gear_ids_path, all_gear_path, max_workers=workers)
+        cached = time.perf_counter() - start
+        cached_requests = stub.request_count - requests_before
+
+    print(f"{count} gear, {latency * 1000:.0f} ms latency")
+    print(f"  serial loop:         {serial:8.2f} s")
+    print(f"  {workers} workers, pooled: {concurrent:8.2f} s  ({serial / concurrent:.1f}x)")
+    print(f"  warm gear cache:     {cached:8.2f} s  ({cached_requests} requests)")
+
+
+def bench_ratelimit(count, short_limit, daily_limit, window, error_rate):
+    # Fetch gear under a simulated quota: the scheduler should pace requests
+    # to the short window, retry 5xx, and stop cleanly at the daily limit with
+    # the gear cache as a checkpoint for the next run.
+    gear = make_gear(count)
+    os.environ.setdefault('STRAVA_ACCESS_TOKEN', 'bench')
+    strava_tools.rate_limiter = strava_tools.RateLimiter(window=window)
+    strava_tools.API_BACKOFF_BASE = 0.05
+    with StubStrava(gear=gear, latency=0.005, short_limit=short_limit, daily_limit=daily_limit,
+                    window=window, error_rate=error_rate) as stub, tempfile.TemporaryDirectory() as tmp:
+        strava_tools.STRAVA_API_URL = stub.url
+        gear_ids_path = os.path.join(tmp, "gear_ids.json")
+        all_gear_path = os.path.join(tmp, "all_gear.json")
+        with open(gear_ids_path, "w") as f:
+            json.dump([g['id'] for g in gear], f)
+
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            runs += 1
+            try:
+                strava_tools.fetch_gear_details(gear_ids_path, all_gear_path)
+                break
+            except strava_tools.RateLimitExceeded as e:
+                print(f"Run {runs} stopped: {e}")
+                stub.reset_daily_usage()
+                strava_tools.rate_limiter.daily_remaining = daily_limit
+        elapsed = time.perf_counter() - start
+        with open(all_gear_path) as f:
+            fetched = json.load(f)
+
+    print(f"{count} gear, {short_limit} requests per {window}s, {daily_limit} per day, {error_rate:.0%} 5xx")
+    print(f"  fetched {len(fetched)}/{count} gear in {runs} runs, {elapsed:.2f} s")
+    print(f"  requests: {stub.request_count}, 429s: {stub.rate_limited_count}, 5xx: {stub.error_count}")
+
+
+def bench_aggregate(count):
+    gear = make_gear(40)
+    activities = make_activities(count, gear)
+    with tempfile.TemporaryDirectory() as tmp:
+        all_gear_path = os.path.join(tmp, "all_gear.json")
+        json_path = os.path.join(tmp, "activities.json")
+        db_path = os.path.join(tmp, "activities.db")
+        with open(all_gear_path, "w") as f:
+            json.dump(gear, f)
+        with open(json_path, "w") as f:
+            json.dump(activities, f, indent=2)
+        del activities
+        strava_tools.open_store(db_path).close()  # one-time migration
+
+        timings = {}
+        start = time.perf_counter()
+        legacy = {prefix: legacy_gear_stats(all_gear_path, json_path, prefix) for prefix in "gb"}
+        timings["per-activity loop (old)"] = time.perf_counter() - start
+        for label, path in [("grouped pass, activities.json", json_path), ("incremental totals, activities.db", db_path)]:
+            start = time.perf_counter()
+            result = {prefix: strava_tools.gear_stats(all_gear_path, path, prefix) for prefix in "gb"}
+            timings[label] = time.perf_counter() - start
+            for prefix in "gb":
+                by_id = {s["id"]: s for s in result[prefix]}
+                for gid, old in legacy[prefix].items():
+                    new = by_id[gid]
+                    assert new["activity_count"] == old["activity_count"]
+                    assert abs(new["total_distance"] - old["total_distance"]) < 1e-3
+                    assert new["first_use"] == old["first_use"]
+
+    print(f"{count} activities, {len(gear)} gear, shoes + bikes")
+    baseline = timings["per-activity loop (old)"]
+    for label, elapsed in timings.items():
+        print(f"  {label:32} {elapsed:8.2f} s  ({baseline / elapsed:.1f}x)")
+
+
+def memory_stage(mode, tmp):
+    # Runs in a fresh process so ru_maxrss is the peak for this mode alone
+    all_gear_path = os.path.join(tmp, "all_gear.json")
+    json_path = os.path.join(tmp, "activities.json")
+    gear_ids_path = os.path.join(tmp, f"gear_ids_{mode}.json")
+    if mode == "json.load":
+        with open(json_path, "r") as f:
+            activities = json.load(f)
+        gear_ids = {a["gear_id"] for a in activities if a.get("gear_id")}
+        del activities
+        for prefix in "gb":
+            legacy_gear_stats(all_gear_path, json_path, prefix)
+    else:
+        path = json_path if mode == "streaming" else os.path.join(tmp, "activities.db")
+        strava_tools.extract_gear_ids_from_activities(path, gear_ids_path)
+        for prefix in "gb":
+            strava_tools.gear_stats(all_gear_path, path, prefix)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"mode": mode, "peak_rss_mb": peak_kb / 1024}))
+
+
+def bench_memory(count):
+    gear = make_gear(40)
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "all_gear.json"), "w") as f:
+            json.dump(gear, f)
+        with open(os.path.join(tmp, "activities.json"), "w") as f:
+            json.dump(make_activities(count, gear), f, indent=2)
+        strava_tools.open_store(os.path.join(tmp, "activities.db")).close()
+        size_mb = os.path.getsize(os.path.join(tmp, "activities.json")) / 2 ** 20
+
+        # Baseline: a process that only imports the pipeline
+        results = {}
+        for mode in ["import only", "json.load", "streaming", "store"]:
+            if mode == "import only":
+                code = "import resource, strava_tools; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)"
+                out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+                results[mode] = float(out.stdout.strip().splitlines()[-1])
+                continue
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "memory-stage", mode, tmp],
+                                 capture_output=True, text=True, check=True)
+            results[mode] = json.loads(out.stdout.strip().splitlines()[-1])["peak_rss_mb"]
+
+    print(f"{count} activities ({size_mb:.0f} MB activities.json): gear extraction + shoe and bike stats")
+    for mode, peak in results.items():
+        print(f"  {mode:12} peak RSS {peak:8.1f} MB")
+
+
+IMPORT_PROBE = """
+import builtins, json, os, socket, sys, time
+os.environ["AUTHORIZATION_CODE"] = "bench"  # used to trigger an OAuth call on import
+connects, opens = [], []
+def no_connect(self, address):
+    connects.append(str(address))
+    raise OSError("network disabled while importing")
+socket.socket.connect = no_connect
+real_open = builtins.open
+def record_open(file, *args, **kwargs):
+    opens.append(str(file))
+    return real_open(file, *args, **kwargs)
+builtins.open = record_open
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "connects": connects, "opens": opens,
+                  "loaded": [m for m in ("requests", "dotenv", "csv") if m in sys.modules]}}))
+"""
+
+
+def bench_import(runs):
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def probe(module):
+        out = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module)],
+                             capture_output=True, text=True, check=True, cwd=here)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+    results = {}
+    for module in ["strava_tools", "requests, dotenv"]:
+        samples = [probe(module) for _ in range(runs)]
+        results[module] = samples
+    tools = results["strava_tools"]
+    print(f"import time, median of {runs} fresh processes")
+    for module, samples in results.items():
+        median = sorted(s["seconds"] for s in samples)[len(samples) // 2]
+        print(f"  import {module:18} {median * 1000:8.1f} ms")
+    connects = sum(len(s["connects"]) for s in tools)
+    opens = sum(len(s["opens"]) for s in tools)
+    print(f"  strava_tools import: {connects} network connections, {opens} files opened, "
+          f"eagerly loaded: {tools[0]['loaded'] or 'none'}")
+    assert connects == 0 and opens == 0
+
+
+def run_suite_scale(count, latency, tmp):
+    # One pass over every stage, each in a metrics.stage; returns the stage records
+    gear = make_gear(40)
+    activities = sorted(make_activities(count, gear), key=lambda a: a["_epoch"])
+    new_count = max(1, count // 100)
+    history, new = activities[:-new_count], activities[-new_count:]
+    db_path = os.path.join(tmp, "activities.db")
+    replay_db_path = os.path.join(tmp, "replay", "activities.db")
+    os.makedirs(os.path.dirname(replay_db_path))
+    cassette = os.path.join(tmp, "fetch.jsonl")
+    gear_ids_path = os.path.join(tmp, "gear_ids.json")
+    all_gear_path = os.path.join(tmp, "all_gear.json")
+    legacy_dir = os.path.join(tmp, "legacy")
+    os.makedirs(legacy_dir)
+    with open(os.path.join(legacy_dir, "activities.json"), "w") as f:
+        json.dump([{k: v for k, v in a.items() if k != "_epoch"} for a in activities], f, indent=2)
+
+    metrics.reset()
+    strava_tools.rate_limiter = strava_tools.RateLimiter(10 ** 9, 10 ** 9)
+    client = strava_tools.StravaClient(access_token="bench")
+    with StubStrava(activities=history, gear=gear, latency=latency) as stub:
+        strava_tools.STRAVA_API_URL = stub.url
+        with metrics.stage("fetch_activities (stub, recorded)"), recording(cassette):
+            strava_tools.fetch_activities(db_path, client=client)
+        with metrics.stage("fetch_activities (replay)"), replaying(cassette):
+            strava_tools.fetch_activities(replay_db_path, client=client)
+        for path in (db_path, replay_db_path):
+            conn = open_store(path)
+            assert strava_tools.count_activities(conn) == len(history)
+            conn.close()
+        stub.activities = activities
+        with metrics.stage("incremental sync"):
+            strava_tools.fetch_activities(db_path, client=client)
+        with metrics.stage("migrate activities.json"):
+            open_store(os.path.join(legacy_dir, "activities.db")).close()
+        with metrics.stage("extract gear ids"):
+            strava_tools.extract_gear_ids_from_activities(db_path, gear_ids_path)
+        with metrics.stage("fetch gear (stub)"):
+            strava_tools.fetch_gear_details(gear_ids_path, all_gear_path, client=client)
+        with metrics.stage("gear stats"):
+            for prefix in "gb":
+                strava_tools.gear_stats(all_gear_path, db_path, prefix)
+        with metrics.stage("league table csv"):
+            strava_tools.combine_shoes(all_gear_path, db_path, os.path.join(tmp, "shoes.csv"))
+            strava_tools.combine_bikes(all_gear_path, db_path, os.path.join(tmp, "bikes.csv"))
+        with metrics.stage("summary query"):
+            conn = open_store(db_path)
+            query_summary(conn, ("year", "month"), sport_type="Run")
+            conn.close()
+    return metrics.as_dict()["stages"]
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def bench_suite(scales, latency, history_path, save, check):
+    history = load_history(history_path)
+    host = platform.node()
+    run = {"timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"), "commit": git_commit(),
+           "python": platform.python_version(), "host": host}
+    results, regressions = [], []
+    for scale in scales:
+        # Quiet the pipeline's own progress output
+        with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                stages = run_suite_scale(scale_count(scale), latency, tmp)
+            finally:
+                sys.stdout = stdout
+
+        print(f"\n{scale} activities")
+        print(f"  {'Stage':34} {'Time(s)':>9} {'Baseline':>9} {'Change':>8} {'Requests':>9}")
+        for s in stages:
+            result = dict(run, scale=scale, stage=s["stage"], seconds=s["seconds"], requests=s["api_requests"],
+                          max_rss_bytes=s.get("max_rss_bytes"))
+            results.append(result)
+            previous = [h["seconds"] for h in history
+                        if h["scale"] == scale and h["stage"] == s["stage"] and h.get("host") == host]
+            previous = previous[-HISTORY_WINDOW:]
+            flag = ""
+            if previous:
+                baseline = statistics.median(previous)
+                change = f"{(s['seconds'] / baseline - 1) * 100:+7.0f}%" if baseline else f"{'-':>8}"
+                if (s["seconds"] > baseline * (1 + REGRESSION_THRESHOLD)
+                        and s["seconds"] - baseline > REGRESSION_MIN_SECONDS):
+                    flag = "  REGRESSION"
+                    regressions.append(result)
+                baseline_str = f"{baseline:9.3f}"
+            else:
+                baseline_str, change = f"{'-':>9}", f"{'-':>8}"
+            print(f"  {s['stage'][:34]:34} {s['seconds']:9.3f} {baseline_str} {change} {s['api_requests']:9}{flag}")
+
+    if save:
+        with open(history_path, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        print(f"\nAppended {len(results)} results to {history_path}")
+    if regressions:
+        print(f"{len(regressions)} stage(s) more than {REGRESSION_THRESHOLD:.0%} slower than the median "
+              f"of their last {HISTORY_WINDOW} runs.")
+        if check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline strava_tools benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    gear_parser = sub.add_parser("gear", help="serial vs concurrent fetch_gear_details")
+    gear_parser.add_argument("--count", type=int, default=200)
+    gear_parser.add_argument("--latency", type=float, default=0.05)
+    gear_parser.add_argument("--workers", type=int, default=strava_tools.GEAR_FETCH_WORKERS)
+    rate_parser = sub.add_parser("ratelimit", help="fetch_gear_details under a simulated rate limit")
+    rate_parser.add_argument("--count", type=int, default=60)
+    rate_parser.add_argument("--short-limit", type=int, default=20)
+    rate_parser.add_argument("--daily-limit", type=int, default=40)
+    rate_parser.add_argument("--window", type=int, default=2)
+    rate_parser.add_argument("--error-rate", type=float, default=0.1)
+    aggregate_parser = sub.add_parser("aggregate", help="per-gear league stats over a synthetic history")
+    aggregate_parser.add_argument("--count", type=int, default=100_000)
+    memory_parser = sub.add_parser("memory", help="peak RSS of json.load vs streaming ingestion")
+    memory_parser.add_argument("--count", type=int, default=100_000)
+    stage_parser = sub.add_parser("memory-stage")
+    stage_parser.add_argument("mode")
+    stage_parser.add_argument("tmp")
+    import_parser = sub.add_parser("import", help="strava_tools import time and side effects")
+    import_parser.add_argument("--runs", type=int, default=7)
+    suite_parser = sub.add_parser("suite", help="time every pipeline stage and track results over time")
+    suite_parser.add_argument("--scales", default="1k,10k", help="comma-separated, e.g. 1k,10k,100k")
+    suite_parser.add_argument("--latency", type=float, default=0.0, help="stub latency per request")
+    suite_parser.add_argument("--history", default=HISTORY_PATH)
+    suite_parser.add_argument("--no-save", action="store_true", help="compare without appending to the history")
+    suite_parser.add_argument("--check", action="store_true", help="exit non-zero if any stage regressed")
+    args = parser.parse_args()
+
+    if args.bench == "gear":
+        bench_gear(args.count, args.latency, args.workers)
+    elif args.bench == "ratelimit":
+        bench_ratelimit(args.count, args.short_limit, args.daily_limit, args.window, args.error_rate)
+    elif args.bench == "aggregate":
+        bench_aggregate(args.count)
+    elif args.bench == "memory":
+        bench_memory(args.count)
+    elif args.bench == "import":
+        bench_import(args.runs)
+    elif args.bench == "memory-stage":
+        memory_stage(args.mode, args.tmp)
+    elif args.bench == "suite":
+        bench_suite(args.scales.split(","), args.latency, args.history, not args.no_save, args.check)
@@ -0,0 +1,152 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlencode
+from pipeline_metrics import metrics, endpoint_name
+
+# On-disk cache of Strava GET responses, used by api_get when the client has
+# one (client.cache). Entries younger than their endpoint's TTL are served
+# without a request. Older ones are revalidated with If-None-Match /
+# If-Modified-Since when Strava sent an ETag or Last-Modified; a 304 reuses the
+# stored body. The file is kept under max_bytes by evicting the least recently
+# used entries. Hits, revalidations and misses are counted in metrics.
+
+# TTL in seconds by endpoint; 0 means always revalidate, None means not cached.
+# The activity list is only ever revalidated so new activities are never
+# hidden, and streams are already kept as arrays by activity_streams.
+HTTP_CACHE_TTLS = {
+    "/athlete/activities": 0,
+    "/activities/{id}": 3600,
+    "/activities/{id}/streams": None,
+    "/gear/{id}": 24 * 3600,
+}
+HTTP_CACHE_DEFAULT_TTL = 0
+HTTP_CACHE_MAX_BYTES = 256 * 2 ** 20
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses(accessed_at);
+"""
+
+def cache_key(url, params):
+    query = urlencode(sorted((params or {}).items()))
+    return hashlib.sha256(f"{url}?{query}".encode()).hexdigest()
+
+class HttpCache:
+    def __init__(self, path, ttls=None, default_ttl=HTTP_CACHE_DEFAULT_TTL, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttls = dict(HTTP_CACHE_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(CACHE_SCHEMA)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "evictions": 0}
+
+    def ttl(self, path):
+        return self.ttls.get(endpoint_name(path), self.default_ttl)
+
+    def lookup(self, path, url, params):
+        # (entry, fresh) where entry is None on a miss or for uncached endpoints
+        if self.ttl(path) is None:
+            return None, False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT key, etag, last_modified, stored_at, body FROM responses WHERE key = ?",
+                (cache_key(url, params),)
+            ).fetchone()
+        if row is None:
+            return None, False
+        entry = {"key": row[0], "etag": row[1], "last_modified": row[2], "stored_at": row[3], "body": row[4]}
+        return entry, time.time() - entry["stored_at"] < self.ttl(path)
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def count(self, outcome, n=1):
+        with self.lock:
+            self.stats[outcome] += n
+        metrics.record_cache(outcome, n)
+
+    def hit(self, entry, revalidated=False):
+        # Fresh hit, or a 304 which restarts the entry's TTL
+        now = time.time()
+        with self.lock, self.conn:
+            if revalidated:
+                self.conn.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?",
+                                  (now, now, entry["key"]))
+            else:
+                self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, entry["key"]))
+        self.count("revalidated" if revalidated else "hits")
+        return entry["body"]
+
+    def store(self, path, url, params, response):
+        if self.ttl(path) is None or response.status_code != 200:
+            return
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if self.ttl(path) == 0 and not etag and not last_modified:
+            # Would always be refetched, so not worth the space
+            return
+        body = response.content
+        key = cache_key(url, params)
+        now = time.time()
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, url, etag, last_modified, stored_at, accessed_at, size, body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, etag, last_modified, now, now, len(body), body)
+            )
+            self.total_bytes += len(body) - (old[0] if old else 0)
+            evicted = self.evict()
+        if evicted:
+            self.count("evictions", evicted)
+
+    def evict(self):
+        # Least recently used first, until the cache fits in max_bytes
+        evicted = 0
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses")
+            self.total_bytes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def print_stats(self):
+        s = self.stats
+        print(f"HTTP cache: {s['hits']} hits, {s['revalidated']} revalidated (304), {s['misses']} misses, "
+              f"{s['evictions']} evicted, {self.total_bytes / 2 ** 20:.1f} MB stored.")
@@ -0,0 +1,147 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import strava_tools
+
+# Record and replay of Strava API traffic, so the pipeline can be rerun
+# offline against exactly what Strava returned:
+#   python run_strava.py --record fixtures/run.jsonl
+#   python run_strava.py --replay fixtures/run.jsonl
+#
+# Every api_get request goes through strava_tools.transport while one of
+# these is installed. Fixtures are JSON lines of {method, path, params,
+# status, headers, body}. The Authorization header is never stored, and
+# OAuth token requests bypass api_get, so fixtures hold no credentials.
+# Responses are matched on method, path and params and replayed in the
+# order they were recorded; the last one repeats once a key runs out.
+
+RECORDED_HEADERS = ["Content-Type", "ETag", "Last-Modified", "X-RateLimit-Limit", "X-RateLimit-Usage"]
+
+class ReplayMiss(Exception):
+    pass
+
+def api_path(url):
+    # Path relative to STRAVA_API_URL, so fixtures replay against any base URL
+    path = urlparse(url).path
+    base = urlparse(strava_tools.STRAVA_API_URL).path
+    return path[len(base):] if base and path.startswith(base + "/") else path
+
+def request_key(method, path, params):
+    return json.dumps([method, path, sorted((k, str(v)) for k, v in (params or {}).items())])
+
+class ReplayHeaders(dict):
+    # Case-insensitive lookups, as requests' headers allow
+    def __init__(self, headers):
+        super().__init__((k.lower(), v) for k, v in headers.items())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+class ReplayResponse:
+    # Just enough of requests.Response for api_get
+    def __init__(self, entry):
+        self.status_code = entry["status"]
+        self.headers = entry["headers"]
+        self.text = entry["body"]
+        self.content = entry["body"].encode()
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+class Recorder:
+    def __init__(self, path, pool_size=16):
+        self.path = path
+        self.session = strava_tools.make_session(pool_size)
+        self.lock = threading.Lock()
+        self.count = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        open(path, "w").close()
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        response = self.session.get(url, headers=headers, params=params, **kwargs)
+        entry = {
+            "method": "GET", "path": api_path(url),
+            "params": {k: str(v) for k, v in (params or {}).items()},
+            "status": response.status_code,
+            "headers": {h: response.headers[h] for h in RECORDED_HEADERS if h in response.headers},
+            "body": response.text,
+        }
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            self.count += 1
+        return response
+
+    def close(self):
+        self.session.close()
+
+class Replayer:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.count = 0
+        with open(path, "r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry["headers"] = ReplayHeaders(entry["headers"])
+                    key = request_key(entry["method"], entry["path"], entry["params"])
+                    self.responses.setdefault(key, []).append(entry)
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        key = request_key("GET", api_path(url), params)
+        with self.lock:
+            entries = self.responses.get(key)
+            if not entries:
+                raise ReplayMiss(f"No recorded response for GET {api_path(url)} {params or ''} in {self.path}")
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            self.count += 1
+        return ReplayResponse(entry)
+
+    def close(self):
+        pass
+
+class ReplayRateLimiter:
+    # Replayed responses cost nothing, so don't pace them
+    daily_remaining = float("inf")
+
+    def acquire(self):
+        pass
+
+    def update(self, headers):
+        pass
+
+    def seconds_until_reset(self):
+        return 0
+
+@contextmanager
+def recording(path):
+    recorder = Recorder(path)
+    previous = strava_tools.transport
+    strava_tools.transport = recorder
+    try:
+        yield recorder
+    finally:
+        strava_tools.transport = previous
+        recorder.close()
+        print(f"Recorded {recorder.count} responses to {path}")
+
+@contextmanager
+def replaying(path):
+    replayer = Replayer(path)
+    previous = strava_tools.transport, strava_tools.rate_limiter
+    strava_tools.transport = replayer
+    strava_tools.rate_limiter = ReplayRateLimiter()
+    try:
+        yield replayer
+    finally:
+        strava_tools.transport, strava_tools.rate_limiter = previous
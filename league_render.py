@@ -0,0 +1,160 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Renders a league table built once by combine_shoes/combine_bikes to the
+# console and to CSV, Markdown, HTML and Parquet files next to output_csv.
+# Cells hold values in display units (km, h); each renderer only serialises
+# them. Files are written in parallel, atomically, and only when their
+# content hash changed, so unchanged tables don't touch the disk (or git).
+# Parquet needs pyarrow and is skipped without it.
+
+LEAGUE_FORMATS = ["csv", "md", "html", "parquet"]
+
+class Column:
+    def __init__(self, key, header, console_header, width, digits=None, console_digits=None):
+        # digits: decimal places in files (0 -> int); None for text columns
+        # console_digits: decimal places on the console; None prints as is
+        self.key = key
+        self.header = header
+        self.console_header = console_header
+        self.width = width
+        self.digits = digits
+        self.console_digits = console_digits
+
+class LeagueTable:
+    def __init__(self, title, columns, rows, footer=None, rule_width=None):
+        self.title = title
+        self.columns = columns
+        self.rows = rows
+        self.footer = footer or []
+        # Console separator length; defaults to the header's
+        self.rule_width = rule_width
+
+    def file_rows(self, include_footer=True):
+        # Rows as written to files, rounded per column
+        rows = self.rows + (self.footer if include_footer else [])
+        return [[file_value(c, row.get(c.key, "")) for c in self.columns] for row in rows]
+
+def file_value(column, value):
+    if column.digits is None or value == "":
+        return value
+    return round(value) if column.digits == 0 else round(value, column.digits)
+
+def console_cell(column, value, first):
+    if first:
+        return f"{str(value)[:column.width]:{column.width}}"
+    if column.console_digits is not None:
+        return f"{value:{column.width}.{column.console_digits}f}"
+    return f"{value:>{column.width}}"
+
+def print_table(table):
+    columns = table.columns
+    header = " ".join(f"{c.console_header:{c.width}}" if i == 0 else f"{c.console_header:>{c.width}}"
+                      for i, c in enumerate(columns))
+    rule = "-" * (table.rule_width or len(header))
+    print(header)
+    print(rule)
+    for row in table.rows:
+        print(" ".join(console_cell(c, row.get(c.key, ""), i == 0) for i, c in enumerate(columns)))
+    if table.footer:
+        print(rule)
+        for row in table.footer:
+            print(" ".join(console_cell(c, row.get(c.key, ""), i == 0) for i, c in enumerate(columns)))
+
+def render_csv(table):
+    import io
+    import csv
+    out = io.StringIO(newline="")
+    writer = csv.writer(out)
+    writer.writerow([c.header for c in table.columns])
+    writer.writerows(table.file_rows())
+    return out.getvalue().encode()
+
+def render_md(table):
+    def cell(value):
+        return str(value).replace("|", "\\|")
+    lines = [
+        "| " + " | ".join(cell(c.header) for c in table.columns) + " |",
+        "|" + "|".join(":---" if c.digits is None else "---:" for c in table.columns) + "|",
+    ]
+    for row in table.file_rows():
+        lines.append("| " + " | ".join(cell(v) for v in row) + " |")
+    return ("\n".join(lines) + "\n").encode()
+
+def render_html(table):
+    from html import escape
+    head = "".join(f"<th>{escape(c.header)}</th>" for c in table.columns)
+    body_rows = table.file_rows(include_footer=False)
+    foot_rows = table.file_rows()[len(body_rows):]
+
+    def tr(row):
+        return "<tr>" + "".join(f"<td>{escape(str(v))}</td>" for v in row) + "</tr>"
+    parts = [
+        "<!DOCTYPE html>",
+        f'<html><head><meta charset="utf-8"><title>{escape(table.title)}</title></head><body>',
+        f"<table><caption>{escape(table.title)}</caption>",
+        f"<thead><tr>{head}</tr></thead>",
+        "<tbody>" + "".join(tr(r) for r in body_rows) + "</tbody>",
+    ]
+    if foot_rows:
+        parts.append("<tfoot>" + "".join(tr(r) for r in foot_rows) + "</tfoot>")
+    parts.append("</table></body></html>")
+    return ("\n".join(parts) + "\n").encode()
+
+def render_parquet(table):
+    # Data only: the totals footer is left out, it can be derived
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    rows = table.file_rows(include_footer=False)
+    arrays = {}
+    for i, c in enumerate(table.columns):
+        values = [row[i] for row in rows]
+        if c.digits is None:
+            arrays[c.header] = pa.array([str(v) for v in values], type=pa.string())
+        elif c.digits == 0:
+            arrays[c.header] = pa.array(values, type=pa.int64())
+        else:
+            arrays[c.header] = pa.array([float(v) for v in values], type=pa.float64())
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.table(arrays), sink)
+    return sink.getvalue().to_pybytes()
+
+RENDERERS = {"csv": render_csv, "md": render_md, "html": render_html, "parquet": render_parquet}
+
+def write_if_changed(path, data):
+    # Atomic replace, skipped when the file already has this content
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+def render_and_write(table, fmt, path):
+    return write_if_changed(path, RENDERERS[fmt](table))
+
+def format_available(fmt):
+    if fmt != "parquet":
+        return True
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def write_league_table(table, output_csv, formats=LEAGUE_FORMATS):
+    # Writes <base>.csv/.md/.html/.parquet in parallel; returns {path: changed}
+    base = os.path.splitext(output_csv)[0]
+    skipped = [fmt for fmt in formats if not format_available(fmt)]
+    if skipped:
+        print(f"Skipping {', '.join(skipped)} output: pyarrow is not installed.")
+    paths = {fmt: output_csv if fmt == "csv" else f"{base}.{fmt}" for fmt in formats if fmt not in skipped}
+    if not paths:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        futures = {path: executor.submit(render_and_write, table, fmt, path) for fmt, path in paths.items()}
+        return {path: future.result() for path, future in futures.items()}
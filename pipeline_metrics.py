@@ -0,0 +1,193 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Instrumentation for pipeline stages and Strava API calls. api_get reports
+# every response to the shared `metrics`; run_strava.py wraps each step in
+# metrics.stage(...) and can write the result as JSON or Prometheus text:
+#   python run_strava.py --metrics metrics.json
+#   python run_strava.py --metrics metrics.prom --profile profiles --trace-memory
+#
+# Stage peak memory is the tracemalloc peak within the stage when
+# --trace-memory is on (slower), otherwise the process max RSS so far.
+
+API_COUNTERS = ["requests", "bytes", "retries", "rate_limited", "errors"]
+API_COUNTER_HELP = {
+    "requests": "Strava API responses received, retries included.",
+    "bytes": "Strava API response body bytes.",
+    "retries": "Strava API requests that were retries.",
+    "rate_limited": "Strava API 429 responses.",
+    "errors": "Strava API 5xx responses.",
+}
+
+def endpoint_name(path):
+    # /activities/123/streams -> /activities/{id}/streams, /gear/b456 -> /gear/{id}
+    return re.sub(r"/(\d+|[bg]\d+)(?=/|$)", "/{id}", path)
+
+def max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.api = {name: 0 for name in API_COUNTERS}
+            self.endpoints = {}
+            self.ratelimit = {}
+            self.cache = {}
+            self.stages = []
+
+    def record_request(self, path, response, attempt):
+        # Called by api_get once per HTTP response, retries included
+        endpoint = endpoint_name(path)
+        size = len(response.content or b"")
+        with self.lock:
+            self.api["requests"] += 1
+            self.api["bytes"] += size
+            if attempt:
+                self.api["retries"] += 1
+            if response.status_code == 429:
+                self.api["rate_limited"] += 1
+            elif response.status_code >= 500:
+                self.api["errors"] += 1
+            counts = self.endpoints.setdefault(endpoint, {"requests": 0, "bytes": 0})
+            counts["requests"] += 1
+            counts["bytes"] += size
+            self.record_headroom(response.headers)
+
+    def record_headroom(self, headers):
+        # Remaining short-window and daily requests from the last response,
+        # plus the lowest seen this run
+        try:
+            limits = [int(x) for x in headers["X-RateLimit-Limit"].split(",")]
+            usage = [int(x) for x in headers["X-RateLimit-Usage"].split(",")]
+        except (KeyError, ValueError):
+            return
+        for window, limit, used in zip(("short", "daily"), limits, usage):
+            remaining = limit - used
+            self.ratelimit[f"{window}_remaining"] = remaining
+            low = self.ratelimit.get(f"{window}_remaining_min")
+            self.ratelimit[f"{window}_remaining_min"] = remaining if low is None else min(low, remaining)
+
+    def record_cache(self, outcome, n=1):
+        # HTTP cache outcomes from http_cache: hits, revalidated, misses, evictions
+        with self.lock:
+            self.cache[outcome] = self.cache.get(outcome, 0) + n
+
+    @contextmanager
+    def stage(self, name, profile_dir=None, trace_memory=False):
+        # Times one pipeline step and attributes the API calls made during it.
+        # cProfile only sees the calling thread, not the worker pools.
+        import tracemalloc
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        profiler = None
+        if profile_dir:
+            import cProfile
+            profiler = cProfile.Profile()
+        with self.lock:
+            api_before = dict(self.api)
+        started_at = time.time()
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            elapsed = time.perf_counter() - start
+            record = {"stage": name, "started_at": started_at, "seconds": round(elapsed, 6)}
+            if tracemalloc.is_tracing():
+                record["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+            else:
+                record["max_rss_bytes"] = max_rss_bytes()
+            if profiler:
+                os.makedirs(profile_dir, exist_ok=True)
+                record["profile"] = os.path.join(profile_dir, f"{name}.prof")
+                profiler.dump_stats(record["profile"])
+            with self.lock:
+                record.update({f"api_{k}": self.api[k] - api_before[k] for k in API_COUNTERS})
+                self.stages.append(record)
+
+    def as_dict(self):
+        with self.lock:
+            return {"stages": list(self.stages), "api": dict(self.api),
+                    "endpoints": {k: dict(v) for k, v in self.endpoints.items()},
+                    "ratelimit": dict(self.ratelimit), "cache": dict(self.cache)}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self):
+        data = self.as_dict()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        stages = data["stages"]
+        metric("strava_stage_duration_seconds", "gauge", "Wall time of each pipeline stage.",
+               [({"stage": s["stage"]}, s["seconds"]) for s in stages])
+        memory_key = "peak_memory_bytes" if any("peak_memory_bytes" in s for s in stages) else "max_rss_bytes"
+        metric(f"strava_stage_{memory_key}", "gauge", "Peak memory during each pipeline stage.",
+               [({"stage": s["stage"]}, s[memory_key]) for s in stages if s.get(memory_key) is not None])
+        metric("strava_stage_api_requests", "gauge", "Strava API requests made during each stage.",
+               [({"stage": s["stage"]}, s["api_requests"]) for s in stages])
+        for counter in API_COUNTERS:
+            metric(f"strava_api_{counter}_total", "counter", API_COUNTER_HELP[counter],
+                   [({}, data["api"][counter])])
+        metric("strava_api_endpoint_requests_total", "counter", "Strava API requests by endpoint.",
+               [({"endpoint": e}, c["requests"]) for e, c in sorted(data["endpoints"].items())])
+        metric("strava_api_endpoint_bytes_total", "counter", "Strava API response bytes by endpoint.",
+               [({"endpoint": e}, c["bytes"]) for e, c in sorted(data["endpoints"].items())])
+        for window in ("short", "daily"):
+            if f"{window}_remaining" in data["ratelimit"]:
+                metric(f"strava_ratelimit_{window}_remaining", "gauge",
+                       f"Requests left in the {window} rate-limit window after the last call.",
+                       [({}, data["ratelimit"][f"{window}_remaining"])])
+                metric(f"strava_ratelimit_{window}_remaining_min", "gauge",
+                       f"Lowest {window} rate-limit headroom seen this run.",
+                       [({}, data["ratelimit"][f"{window}_remaining_min"])])
+        for outcome, value in sorted(data["cache"].items()):
+            metric(f"strava_http_cache_{outcome}_total", "counter", f"HTTP cache {outcome}.", [({}, value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, fmt=None):
+        # Format from fmt, else from the extension (.prom/.txt -> Prometheus)
+        fmt = fmt or ("prometheus" if path.endswith((".prom", ".txt")) else "json")
+        text = self.to_prometheus() if fmt == "prometheus" else self.to_json()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def print_summary(self):
+        print(f"\n{'Stage':24} {'Time(s)':>9} {'Requests':>9} {'KB':>9} {'Retries':>8} {'Peak MB':>9}")
+        print("-" * 72)
+        for s in self.as_dict()["stages"]:
+            peak = s.get("peak_memory_bytes", s.get("max_rss_bytes"))
+            peak_str = f"{peak / 2 ** 20:9.1f}" if peak is not None else f"{'-':>9}"
+            print(f"{s['stage'][:24]:24} {s['seconds']:9.2f} {s['api_requests']:9} "
+                  f"{s['api_bytes'] / 1024:9.1f} {s['api_retries']:8} {peak_str}")
+
+metrics = Metrics()
@@ -1,93 +1,118 @@
 from strava_tools import (
-    fetch_activities, extract_gear_ids_from_activities, fetch_gear_details,
-    combine_shoes, combine_bikes, refresh_access_token, exchange_code_for_tokens
+    fetch_activities, full_resync, extract_gear_ids_from_activities, fetch_gear_details,
+    combine_shoes, combine_bikes, verify_aggregates, exchange_code_for_tokens, StravaClient
 )
+from pipeline_metrics import metrics
+from http_cache import HttpCache, HTTP_CACHE_MAX_BYTES
+from http_fixtures import recording, replaying
+from contextlib import ExitStack
 import os
-from dotenv import load_dotenv
-import time
+import argparse
+
+parser = argparse.ArgumentParser(description="Update activities, gear and league tables from Strava")
+parser.add_argument("--full-resync", action="store_true",
+                    help="re-download the whole activity history, in parallel by date window")
+parser.add_argument("--verify-aggregates", action="store_true",
+                    help="check the incrementally maintained gear totals against a full recompute")
+parser.add_argument("--streams", action="store_true",
+                    help="also download per-second streams for activities that don't have them (needs numpy)")
+parser.add_argument("--metrics", metavar="PATH",
+                    help="write stage timings and API counters here (.prom/.txt for Prometheus text, else JSON)")
+parser.add_argument("--metrics-format", choices=["json", "prometheus"], help="override the format chosen from --metrics")
+parser.add_argument("--profile", metavar="DIR", help="write a cProfile .prof file per stage to DIR")
+parser.add_argument("--trace-memory", action="store_true",
+                    help="measure each stage's peak Python memory with tracemalloc (slower)")
+parser.add_argument("--no-http-cache", action="store_true", help="don't use the on-disk cache of API responses")
+parser.add_argument("--http-cache-max-mb", type=float, default=HTTP_CACHE_MAX_BYTES / 2 ** 20,
+                    help="evict least recently used cached responses beyond this size")
+parser.add_argument("--record", metavar="PATH", help="save every API response to this fixture file")
+parser.add_argument("--replay", metavar="PATH",
+                    help="run offline against a fixture file from --record instead of Strava (no auth needed)")
+parser.add_argument("--data-dir", help="where activities.db, gear and league tables live (default: this directory)")
+args = parser.parse_args()
+
+def stage(name):
+    return metrics.stage(name, profile_dir=args.profile, trace_memory=args.trace_memory)
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
-activities_path = os.path.join(script_dir, "activities.json")
-gear_ids_path = os.path.join(script_dir, "gear_ids.json")
-all_gear_path = os.path.join(script_dir, "all_gear.json")
-shoes_csv = os.path.join(script_dir, "shoe_league_table.csv")
-bikes_csv = os.path.join(script_dir, "bike_league_table.csv")
+data_dir = args.data_dir or script_dir
+os.makedirs(data_dir, exist_ok=True)
+# activities.db is created from an existing activities.json on first run
+activities_path = os.path.join(data_dir, "activities.db")
+gear_ids_path = os.path.join(data_dir, "gear_ids.json")
+all_gear_path = os.path.join(data_dir, "all_gear.json")
+shoes_csv = os.path.join(data_dir, "shoe_league_table.csv")
+bikes_csv = os.path.join(data_dir, "bike_league_table.csv")
 
-# Step 0: Ensure access token is valid (handle first-time and refresh)
-load_dotenv()
-client_id = os.getenv('CLIENT_ID')
-client_secret = os.getenv('CLIENT_SECRET')
-refresh_token = os.getenv('STRAVA_REFRESH_TOKEN')
+# Step 0: Ensure access token is valid (handle first-time and refresh).
+# The client's token manager refreshes it again if it expires mid-run.
+# Fixtures record what Strava actually sent, so they bypass the HTTP cache.
+cache = None
+if not args.no_http_cache and not args.record and not args.replay:
+    cache = HttpCache(os.path.join(data_dir, "http_cache.db"), max_bytes=int(args.http_cache_max_mb * 2 ** 20))
+fixtures = ExitStack()
+if args.replay:
+    client = StravaClient(access_token="replay")
+    fixtures.enter_context(replaying(args.replay))
+else:
+    client = StravaClient.from_env(os.path.join(script_dir, ".env"), cache=cache)
 authorization_code = os.getenv('AUTHORIZATION_CODE')
-access_token = os.getenv('STRAVA_ACCESS_TOKEN')
-expires_at = os.getenv('STRAVA_EXPIRES_AT')
 
-now = int(time.time())
+# Replayed fixtures need no tokens
+if not args.replay:
+    with stage("auth"):
+        if client.tokens.refresh_token:
+            client.tokens.token()
+        elif authorization_code:
+            print("No refresh token found. Exchanging authorization code for tokens...")
+            new_access_token, new_refresh_token, new_expires_at = exchange_code_for_tokens(client.client_id, client.client_secret, authorization_code)
+            if not new_access_token or not new_refresh_token or not new_expires_at:
+                raise Exception("Failed to exchange authorization code for tokens. Please check your code and try again.")
+            client.tokens.set_tokens({"access_token": new_access_token, "refresh_token": new_refresh_token,
+                                      "expires_at": new_expires_at})
+        else:
+            raise Exception("No refresh token or authorization code found. Please authorize the app with Strava.")
 
-if expires_at and access_token and int(expires_at) > now:
-    print("Access token is still valid, using existing token.")
-    os.environ['STRAVA_ACCESS_TOKEN'] = access_token
-elif refresh_token:
-    print("Access token expired or missing, refreshing using refresh token...")
-    new_access_token, new_refresh_token, new_expires_at = refresh_access_token(client_id, client_secret, refresh_token)
-    if not new_access_token or not new_refresh_token or not new_expires_at:
-        raise Exception("Failed to refresh access token. Please check your refresh token and try again.")
-    os.environ['STRAVA_ACCESS_TOKEN'] = new_access_token
-    os.environ['STRAVA_REFRESH_TOKEN'] = new_refresh_token
-    os.environ['STRAVA_EXPIRES_AT'] = str(new_expires_at)
-    # --- Update .env file with new tokens and expiry ---
-    env_path = os.path.join(script_dir, ".env")
-    if os.path.exists(env_path):
-        with open(env_path, "r") as f:
-            lines = f.readlines()
-    else:
-        lines = []
-    new_lines = []
-    found_access = found_refresh = found_expiry = False
-    for line in lines:
-        if line.startswith("STRAVA_ACCESS_TOKEN="):
-            new_lines.append(f"STRAVA_ACCESS_TOKEN={new_access_token}\n")
-            found_access = True
-        elif line.startswith("STRAVA_REFRESH_TOKEN="):
-            new_lines.append(f"STRAVA_REFRESH_TOKEN={new_refresh_token}\n")
-            found_refresh = True
-        elif line.startswith("STRAVA_EXPIRES_AT="):
-            new_lines.append(f"STRAVA_EXPIRES_AT={new_expires_at}\n")
-            found_expiry = True
+if args.record:
+    fixtures.enter_context(recording(args.record))
+
+try:
+    # Step 1: Download activities first
+    with stage("fetch_activities"):
+        if args.full_resync:
+            new_activities_count = full_resync(activities_path, client=client)
         else:
-            new_lines.append(line)
-    if not found_access:
-        new_lines.append(f"STRAVA_ACCESS_TOKEN={new_access_token}\n")
-    if not found_refresh:
-        new_lines.append(f"STRAVA_REFRESH_TOKEN={new_refresh_token}\n")
-    if not found_expiry:
-        new_lines.append(f"STRAVA_EXPIRES_AT={new_expires_at}\n")
-    with open(env_path, "w") as f:
-        f.writelines(new_lines)
-    print(".env file updated with refreshed tokens and expiry.")
-elif authorization_code:
-    print("No refresh token found. Exchanging authorization code for tokens...")
-    new_access_token, new_refresh_token, new_expires_at = exchange_code_for_tokens(client_id, client_secret, authorization_code)
-    if not new_access_token or not new_refresh_token or not new_expires_at:
-        raise Exception("Failed to exchange authorization code for tokens. Please check your code and try again.")
-    os.environ['STRAVA_ACCESS_TOKEN'] = new_access_token
-    os.environ['STRAVA_REFRESH_TOKEN'] = new_refresh_token
-    os.environ['STRAVA_EXPIRES_AT'] = str(new_expires_at)
-else:
-    raise Exception("No refresh token or authorization code found. Please authorize the app with Strava.")
+            new_activities_count = fetch_activities(activities_path, client=client)
 
-# Step 1: Download activities first
-new_activities_count = fetch_activities(activities_path)
+    if new_activities_count == 0:
+        print("No new activities. Skipping gear and league table updates.")
+    else:
+        # Step 2: Extract gear IDs from activities
+        with stage("extract_gear_ids"):
+            extract_gear_ids_from_activities(activities_path, gear_ids_path)
 
-if new_activities_count == 0:
-    print("No new activities. Skipping gear and league table updates.")
-else:
-    # Step 2: Extract gear IDs from activities
-    extract_gear_ids_from_activities(activities_path, gear_ids_path)
+        # Step 3: Download gear details
+        with stage("fetch_gear_details"):
+            fetch_gear_details(gear_ids_path, all_gear_path, client=client)
+
+        # Step 4: Generate league tables
+        with stage("league_tables"):
+            combine_shoes(all_gear_path, activities_path, shoes_csv)
+            combine_bikes(all_gear_path, activities_path, bikes_csv)
 
-    # Step 3: Download gear details
-    fetch_gear_details(gear_ids_path, all_gear_path)
+    if args.streams:
+        from activity_streams import fetch_streams
+        with stage("fetch_streams"):
+            fetch_streams(activities_path, os.path.join(data_dir, "streams"), client=client)
 
-    # Step 4: Generate league tables
-    combine_shoes(all_gear_path, activities_path, shoes_csv)
-    combine_bikes(all_gear_path, activities_path, bikes_csv)
\ No newline at end of file
+    if args.verify_aggregates:
+        with stage("verify_aggregates"):
+            verify_aggregates(activities_path)
+finally:
+    fixtures.close()
+    if cache:
+        cache.print_stats()
+    # Written even when a stage fails, so the failing run can be inspected
+    if args.metrics:
+        metrics.write(args.metrics, args.metrics_format)
+        metrics.print_summary()
@@ -1,332 +1,668 @@
 import os
 import json
-from datetime import datetime
-import requests
-from dotenv import load_dotenv
-
-load_dotenv()
-access_token = os.getenv('STRAVA_ACCESS_TOKEN')
-refresh_token = os.getenv('STRAVA_REFRESH_TOKEN')
-client_id = os.getenv('CLIENT_ID')
-client_secret = os.getenv('CLIENT_SECRET')
-
-def fetch_activities(json_path):
-    access_token = os.environ.get('STRAVA_ACCESS_TOKEN')
-    # Download all activities if file doesn't exist, else only new ones
-    if os.path.exists(json_path):
-        with open(json_path, "r") as f:
-            existing_activities = json.load(f)
-        if existing_activities:
-            most_recent = max(
-                existing_activities,
-                key=lambda x: x.get("start_date_local", x.get("start_date", "1970-01-01T00:00:00Z"))
-            )
-            most_recent_date = most_recent.get("start_date_local", most_recent.get("start_date"))
-            most_recent_dt = datetime.strptime(most_recent_date[:19], "%Y-%m-%dT%H:%M:%S")
-        else:
-            most_recent_dt = None  # None means fetch all
-    else:
-        existing_activities = []
-        most_recent_dt = None  # None means fetch all
-
-    def get_new_activities(after_datetime):
-        all_new_activities = []
-        page = 1
-        per_page = 200
-        max_pages = 20
-        params = {'per_page': per_page, 'page': page}
-        if after_datetime:
-            params['after'] = int(after_datetime.timestamp())
-        while page <= max_pages:
-            params['page'] = page
-            response = requests.get(
-                url='https://www.strava.com/api/v3/athlete/activities',
-                headers={'Authorization': f'Bearer {access_token}'},
-                params=params
-            )
-            # --- Check for access token errors ---
-            if response.status_code == 401:
-                print("Error: Unauthorized. Your access token is invalid or expired.")
-                print("Response:", response.text)
-                raise Exception("Access token failed. Please refresh your token.")
-            try:
-                activities = response.json()
-            except Exception:
-                print("Failed to parse JSON. Response text:")
-                print(response.text)
-                raise
-            if isinstance(activities, dict) and activities.get("errors"):
-                print("Strava API error:", activities)
-                raise Exception("Access token failed or other API error.")
-            if not isinstance(activities, list) or not activities:
+import time
+import calendar
+import queue
+import random
+import shutil
+import stat
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: .env writes stay atomic but aren't serialised
+from activity_store import (
+    open_store, insert_activities, count_activities, latest_activity,
+    distinct_gear_ids, iter_activity_rows, load_gear_totals, empty_gear_totals,
+    verify_gear_totals, rebuild_gear_totals
+)
+from pipeline_metrics import metrics
+from league_render import Column, LeagueTable, LEAGUE_FORMATS, print_table, write_league_table
+
+# Importing this module does no I/O: requests, csv and dotenv are imported
+# where they are used, and credentials come from a StravaClient passed in
+# (or, by default, from the STRAVA_* environment variables at call time).
+
+STRAVA_API_URL = 'https://www.strava.com/api/v3'
+STRAVA_OAUTH_URL = 'https://www.strava.com/oauth/token'
+ACTIVITIES_PER_PAGE = 200
+BACKFILL_WORKERS = 4
+BACKFILL_WINDOW_DAYS = 365
+BACKFILL_START = datetime(2009, 1, 1, tzinfo=timezone.utc)  # Strava's launch
+GEAR_FETCH_WORKERS = 8
+GEAR_CACHE_TTL = 7 * 24 * 3600  # seconds before active gear is refetched
+
+TOKEN_REFRESH_MARGIN = 300  # seconds before expires_at to refresh
+
+API_MAX_RETRIES = 5
+API_BACKOFF_BASE = 2  # seconds, doubled on each retry
+
+class StravaAPIError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(f"Strava API error {status_code}: {message}")
+        self.status_code = status_code
+
+class RateLimitExceeded(StravaAPIError):
+    pass
+
+def utc_day():
+    return time.gmtime()[:3]
+
+class RateLimiter:
+    # Token bucket paced to Strava's 15-minute limit. The bucket is corrected
+    # from the X-RateLimit-Limit / X-RateLimit-Usage headers ("15min,daily")
+    # on every response, so usage by other processes is accounted for too.
+    # The daily allowance resets at midnight UTC.
+    def __init__(self, short_limit=100, daily_limit=1000, window=900):
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.window = window
+        self.tokens = float(short_limit)
+        self.daily_remaining = daily_limit
+        self.day = utc_day()
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.short_limit / self.window
+        self.tokens = min(self.short_limit, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        day = utc_day()
+        if day != self.day:
+            self.day = day
+            self.daily_remaining = self.daily_limit
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill()
+                if self.daily_remaining <= 0:
+                    raise RateLimitExceeded(429, "Daily rate limit used up, try again tomorrow.")
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * self.window / self.short_limit
+            time.sleep(wait)
+
+    def update(self, headers):
+        limit = headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-RateLimit-Usage')
+        if not limit or not usage:
+            return
+        try:
+            short_limit, daily_limit = (int(x) for x in limit.split(','))
+            short_usage, daily_usage = (int(x) for x in usage.split(','))
+        except ValueError:
+            return
+        with self.lock:
+            self._refill()
+            self.short_limit = short_limit
+            self.daily_limit = daily_limit
+            self.tokens = min(self.tokens, short_limit - short_usage)
+            self.daily_remaining = daily_limit - daily_usage
+
+    def seconds_until_reset(self):
+        # Strava's 15-minute windows reset on the quarter hour
+        return self.window - (time.time() % self.window)
+
+rate_limiter = RateLimiter()
+
+# When set, api_get sends every request through this instead of the network
+# or the caller's session; http_fixtures uses it to record and replay traffic
+transport = None
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, API_BACKOFF_BASE * 2 ** attempt)
+
+class StravaClient:
+    # Credentials and app configuration for one athlete. With a TokenManager
+    # the access token is refreshed as needed; otherwise it is used as given.
+    # cache is an optional http_cache.HttpCache for this athlete's responses.
+    def __init__(self, access_token=None, refresh_token=None, expires_at=None,
+                 client_id=None, client_secret=None, tokens=None, cache=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.tokens = tokens
+        self.cache = cache
+        self._access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_env(cls, env_path=None, cache=None):
+        # Reads .env into os.environ, then the STRAVA_* vars; refreshed tokens
+        # are written back to the same .env
+        from dotenv import load_dotenv
+        env_path = env_path or default_env_path()
+        load_dotenv(env_path)
+        tokens = TokenManager(
+            os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'),
+            access_token=os.getenv('STRAVA_ACCESS_TOKEN'),
+            refresh_token=os.getenv('STRAVA_REFRESH_TOKEN'),
+            expires_at=os.getenv('STRAVA_EXPIRES_AT'),
+            store=EnvFileTokenStore(env_path),
+        )
+        return cls(client_id=tokens.client_id, client_secret=tokens.client_secret, tokens=tokens, cache=cache)
+
+    @property
+    def access_token(self):
+        if self.tokens:
+            return self.tokens.token()
+        return self._access_token
+
+    def get(self, path, params=None, session=None, revalidate=False):
+        return api_get(path, params=params, session=session, client=self, revalidate=revalidate)
+
+def env_client():
+    # Default client for callers that don't pass one: whatever token is in
+    # the environment when the call is made
+    return StravaClient(access_token=os.environ.get('STRAVA_ACCESS_TOKEN'))
+
+def api_get(path, params=None, session=None, client=None, revalidate=False):
+    # Every Strava API call goes through here: paced by rate_limiter, with
+    # 429 and 5xx responses retried after a jittered backoff. rate_limiter is
+    # shared by all threads, so concurrent athletes share one budget. Every
+    # response is counted in pipeline_metrics.metrics. If the client has an
+    # HttpCache, fresh entries are served from it and stale ones revalidated;
+    # revalidate=True skips the TTL when the caller knows the data changed.
+    import requests
+    client = client or env_client()
+    url = f'{STRAVA_API_URL}{path}'
+    cache = getattr(client, 'cache', None)
+    entry = None
+    if cache:
+        entry, fresh = cache.lookup(path, url, params)
+        if entry and fresh and not revalidate:
+            return json.loads(cache.hit(entry))
+    access_token = client.access_token
+    http = transport or session or requests
+    refreshed = False
+    for attempt in range(API_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        headers = {'Authorization': f'Bearer {access_token}'}
+        if cache:
+            headers.update(cache.conditional_headers(entry))
+        response = http.get(url=url, headers=headers, params=params)
+        rate_limiter.update(response.headers)
+        metrics.record_request(path, response, attempt)
+        if response.status_code == 401 and client.tokens and not refreshed:
+            # Token revoked or expired early: refresh once and retry
+            access_token = client.tokens.refresh_after_401(access_token)
+            refreshed = True
+            continue
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        if attempt == API_MAX_RETRIES:
+            break
+        if response.status_code == 429:
+            if rate_limiter.daily_remaining <= 0:
                 break
-            all_new_activities.extend(activities)
-            page += 1
-        return all_new_activities
-
-    new_activities = get_new_activities(most_recent_dt)
-    if not existing_activities and new_activities:
-        unique_activities = sorted(new_activities, key=lambda x: x.get("start_date_local", x.get("start_date", "")), reverse=True)
-        with open(json_path, "w") as f:
-            json.dump(unique_activities, f, indent=2)
-        print(f"Created activities.json with {len(unique_activities)} activities.")
-        return len(new_activities)
-    elif new_activities:
-        all_activities = existing_activities + new_activities
-        unique_activities = {a['id']: a for a in all_activities}.values()
-        unique_activities = sorted(unique_activities, key=lambda x: x.get("start_date_local", x.get("start_date", "")), reverse=True)
-        with open(json_path, "w") as f:
-            json.dump(unique_activities, f, indent=2)
-        print(f"Added {len(new_activities)} new activities. Total now: {len(unique_activities)}")
-        return len(new_activities)
+            delay = rate_limiter.seconds_until_reset() + backoff_delay(0)
+        else:
+            delay = backoff_delay(attempt)
+        print(f"Strava returned {response.status_code} for {path}, retrying in {delay:.1f}s...")
+        time.sleep(delay)
+
+    if response.status_code == 304 and entry:
+        return json.loads(cache.hit(entry, revalidated=True))
+    if cache and cache.ttl(path) is not None:
+        cache.count("misses")
+
+    # --- Check for access token errors ---
+    if response.status_code == 401:
+        print("Error: Unauthorized. Your access token is invalid or expired.")
+        print("Response:", response.text)
+        raise StravaAPIError(401, "Access token failed. Please refresh your token.")
+    if response.status_code == 429:
+        raise RateLimitExceeded(429, response.text)
+    if not response.ok:
+        raise StravaAPIError(response.status_code, response.text)
+    try:
+        data = response.json()
+    except Exception:
+        print("Failed to parse JSON. Response text:")
+        print(response.text)
+        raise
+    if cache:
+        cache.store(path, url, params, response)
+    return data
+
+def make_session(pool_size=GEAR_FETCH_WORKERS):
+    # One pooled session so concurrent requests reuse TLS connections
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def utc_epoch(date_str):
+    # Strava's start_date is UTC ("2024-05-01T07:30:00Z"); start_date_local
+    # carries no offset, so it must not be used for the sync high-water mark
+    return calendar.timegm(time.strptime(date_str[:19], "%Y-%m-%dT%H:%M:%S"))
+
+def sync_manifest_path(db_path):
+    return os.path.splitext(db_path)[0] + "_sync.json"
+
+def write_json_atomic(path, data):
+    # The temp file is unique to this thread and created with the mode of the
+    # file it replaces, so concurrent writers don't share it and a private
+    # file (such as batch_strava's roster of secrets) is never exposed
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = None
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if mode is None else mode)
+    try:
+        with os.fdopen(fd, "w") as f:
+            if mode is not None:
+                os.chmod(tmp_path, mode)
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def load_sync_manifest(manifest_path, conn):
+    # {"last_synced_epoch": int or None, "last_activity_id": int or None,
+    #  "cursor": {"after": ..., "page": ...} while a sync is in progress}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    # No manifest yet: derive the high-water mark from the store once
+    latest = latest_activity(conn)
+    return {
+        "last_synced_epoch": utc_epoch(latest[1]) if latest else None,
+        "last_activity_id": latest[0] if latest else None,
+        "cursor": None,
+    }
+
+def get_activity_page(params, client=None):
+    activities = api_get('/athlete/activities', params=params, client=client)
+    if isinstance(activities, dict) and activities.get("errors"):
+        print("Strava API error:", activities)
+        raise Exception("Access token failed or other API error.")
+    if not isinstance(activities, list):
+        return []
+    return activities
+
+def fetch_activities(db_path, client=None):
+    # Download all activities if the store is empty, else only new ones.
+    # An existing activities.json next to db_path is migrated on first run.
+    conn = open_store(db_path)
+    manifest_path = sync_manifest_path(db_path)
+    manifest = load_sync_manifest(manifest_path, conn)
+    after = manifest["last_synced_epoch"]
+    # First download, or one that was interrupted: backfill in parallel
+    if after is None or os.path.exists(backfill_checkpoint_path(db_path)):
+        conn.close()
+        return backfill_activities(db_path, client=client)
+
+    params = {'per_page': ACTIVITIES_PER_PAGE, 'after': after}
+    page = 1
+    # Resume a sync that was interrupted (e.g. by the daily rate limit)
+    cursor = manifest.get("cursor")
+    if cursor and cursor["after"] == after:
+        page = cursor["page"]
+        print(f"Resuming activity sync from page {page}.")
+
+    added = 0
+    last_epoch, last_id = after, manifest["last_activity_id"]
+    while True:
+        params['page'] = page
+        activities = get_activity_page(params, client)
+        if not activities:
+            break
+        # Each page is stored straight away, so the cursor only needs the page
+        added += insert_activities(conn, activities)
+        for activity in activities:
+            epoch = utc_epoch(activity["start_date"])
+            if last_epoch is None or epoch > last_epoch:
+                last_epoch, last_id = epoch, activity["id"]
+        page += 1
+        manifest["cursor"] = {"after": after, "page": page}
+        write_json_atomic(manifest_path, manifest)
+
+    manifest.update(last_synced_epoch=last_epoch, last_activity_id=last_id, cursor=None)
+    write_json_atomic(manifest_path, manifest)
+    if added:
+        print(f"Added {added} new activities. Total now: {count_activities(conn)}")
     else:
         print("No new activities to add.")
-        return 0
+    conn.close()
+    return added
+
+def backfill_windows(now=None, window_days=BACKFILL_WINDOW_DAYS):
+    # (after, before) epoch windows covering all of history, newest first.
+    # Boundaries sit on a fixed grid from BACKFILL_START and the newest window
+    # has no upper bound (before is None), so a backfill makes the same
+    # requests whenever it runs and can't miss an upload made during it.
+    # The last window catches anything uploaded from before Strava existed.
+    now = int(now or time.time())
+    step = window_days * 24 * 3600
+    start = calendar.timegm(BACKFILL_START.timetuple())
+    boundaries = list(range(start, now + 1, step))
+    windows = [(after - 1, before) for after, before in zip(boundaries, boundaries[1:] + [None])]
+    windows.reverse()
+    windows.append((0, start))
+    return windows
+
+def backfill_checkpoint_path(db_path):
+    return os.path.splitext(db_path)[0] + "_backfill.json"
+
+def backfill_activities(db_path, max_workers=BACKFILL_WORKERS, client=None):
+    # Download the whole history, paging date windows concurrently. Pages are
+    # handed to this thread through a queue and upserted as they arrive, and
+    # each window's next page is checkpointed once its activities are stored,
+    # so an interrupted backfill picks up where it stopped.
+    conn = open_store(db_path)
+    checkpoint_path = backfill_checkpoint_path(db_path)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+        print("Resuming interrupted backfill.")
+    else:
+        checkpoint = {"windows": [
+            {"after": after, "before": before, "page": 1, "done": False}
+            for after, before in backfill_windows()
+        ]}
+        write_json_atomic(checkpoint_path, checkpoint)
+    pending = [w for w in checkpoint["windows"] if not w["done"]]
+
+    pages = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+
+    def fetch_window(window):
+        page = window["page"]
+        while not stop.is_set():
+            params = {'per_page': ACTIVITIES_PER_PAGE, 'page': page, 'after': window["after"]}
+            if window["before"] is not None:
+                params['before'] = window["before"]
+            activities = get_activity_page(params, client)
+            while not stop.is_set():
+                try:
+                    pages.put((window, page, activities), timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+            if not activities:
+                return
+            page += 1
+
+    fetched = added = 0
+    remaining = len(pending)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_window, w) for w in pending]
+        try:
+            while remaining:
+                try:
+                    window, page, activities = pages.get(timeout=0.5)
+                except queue.Empty:
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+                    continue
+                if activities:
+                    fetched += len(activities)
+                    added += insert_activities(conn, activities)
+                    window["page"] = page + 1
+                else:
+                    window["done"] = True
+                    remaining -= 1
+                write_json_atomic(checkpoint_path, checkpoint)
+        finally:
+            stop.set()
+
+    latest = latest_activity(conn)
+    write_json_atomic(sync_manifest_path(db_path), {
+        "last_synced_epoch": utc_epoch(latest[1]) if latest else None,
+        "last_activity_id": latest[0] if latest else None,
+        "cursor": None,
+    })
+    os.remove(checkpoint_path)
+    print(f"Backfill fetched {fetched} activities across {len(checkpoint['windows'])} windows "
+          f"({added} new). Total now: {count_activities(conn)}")
+    conn.close()
+    return added
+
+def full_resync(db_path, max_workers=BACKFILL_WORKERS, client=None):
+    # Re-download the whole history; the upsert keeps the store deduplicated
+    return backfill_activities(db_path, max_workers, client)
 
 def extract_gear_ids_from_activities(activities_path, gear_ids_path):
-    access_token = os.environ.get('STRAVA_ACCESS_TOKEN')
-    with open(activities_path, "r") as f:
-        activities = json.load(f)
-    gear_ids = set()
-    for activity in activities:
-        gear_id = activity.get("gear_id")
-        if gear_id:
-            gear_ids.add(gear_id)
+    if activities_path.endswith(".json"):
+        gear_ids = {a["gear_id"] for a in iter_activity_rows(activities_path, ["gear_id"]) if a["gear_id"]}
+    else:
+        conn = open_store(activities_path)
+        gear_ids = distinct_gear_ids(conn)
+        conn.close()
     with open(gear_ids_path, "w") as f:
-        json.dump(list(gear_ids), f)
+        json.dump(sorted(gear_ids), f)
     print(f"Extracted {len(gear_ids)} gear IDs from activities.")
 
-def fetch_gear_details(gear_ids_path, all_gear_path):
-    access_token = os.environ.get('STRAVA_ACCESS_TOKEN')
+def gear_cache_path(all_gear_path):
+    return os.path.join(os.path.dirname(os.path.abspath(all_gear_path)), "gear_cache.json")
+
+def load_gear_cache(cache_path, all_gear_path=None):
+    # {gear_id: {"fetched_at": epoch seconds, "gear": {...}}}, with
+    # "gear": None and "missing": True for IDs Strava answered 404 for
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    # No cache yet: seed it from an existing all_gear.json so the first
+    # cached run doesn't refetch everything
+    if all_gear_path and os.path.exists(all_gear_path):
+        fetched_at = os.path.getmtime(all_gear_path)
+        with open(all_gear_path, "r") as f:
+            return {g["id"]: {"fetched_at": fetched_at, "gear": g} for g in json.load(f) if "id" in g}
+    return {}
+
+def is_gear_stale(entry, now, ttl):
+    # Retired gear never changes, so once cached it never expires. Missing
+    # gear is retried after the same TTL, in case it becomes visible again.
+    if entry.get("missing"):
+        return now - entry["fetched_at"] > ttl
+    if entry["gear"].get("retired"):
+        return False
+    return now - entry["fetched_at"] > ttl
+
+def fetch_gear_details(gear_ids_path, all_gear_path, max_workers=GEAR_FETCH_WORKERS, cache_ttl=GEAR_CACHE_TTL,
+                       client=None):
     with open(gear_ids_path, "r") as f:
         gear_ids = json.load(f)
-    all_gear = []
-    for gid in gear_ids:
-        response = requests.get(
-            url=f'https://www.strava.com/api/v3/gear/{gid}',
-            headers={'Authorization': f'Bearer {access_token}'}
-        )
-        gear = response.json()
-        all_gear.append(gear)
+    # Sort so all_gear.json comes out in the same order every run
+    gear_ids = sorted(gear_ids)
+    cache_path = gear_cache_path(all_gear_path)
+    cache = load_gear_cache(cache_path, all_gear_path)
+    now = time.time()
+    # Evict gear no longer referenced by any activity
+    wanted = set(gear_ids)
+    cache = {gid: entry for gid, entry in cache.items() if gid in wanted}
+    to_fetch = [gid for gid in gear_ids if gid not in cache or is_gear_stale(cache[gid], now, cache_ttl)]
+
+    max_workers = max(1, min(max_workers, len(to_fetch)))
+    try:
+        # The pool size caps the number of requests in flight
+        with make_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(api_get, f'/gear/{gid}', session=session, client=client): gid for gid in to_fetch}
+            for future in as_completed(futures):
+                gid = futures[future]
+                try:
+                    cache[gid] = {"fetched_at": now, "gear": future.result()}
+                except StravaAPIError as e:
+                    if e.status_code != 404:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+                    print(f"Gear {gid} not found on Strava, skipping.")
+                    cache[gid] = {"fetched_at": now, "gear": None, "missing": True}
+    finally:
+        # Keep whatever was fetched so an interrupted run resumes from here
+        write_json_atomic(cache_path, cache)
+
+    all_gear = [cache[gid]["gear"] for gid in gear_ids if gid in cache and not cache[gid].get("missing")]
     with open(all_gear_path, "w") as f:
         json.dump(all_gear, f, indent=2)
+    print(f"Fetched {len(to_fetch)} of {len(gear_ids)} gear items ({len(gear_ids) - len(to_fetch)} cached).")
     print(f"Saved all gear details to {all_gear_path}")
 
-def combine_shoes(all_gear_path, activities_path, output_csv):
-    # Load data
+def gear_stats(all_gear_path, activities_path, prefix):
+    # Per-gear league stats for gear whose ID starts with prefix ('g' for
+    # shoes, 'b' for bikes), from a single grouped pass over the activities
     with open(all_gear_path, "r") as f:
         all_gear = json.load(f)
-    with open(activities_path, "r") as f:
-        activities = json.load(f)
-
-    # Filter only shoes from all_gear (IDs starting with 'g')
-    shoes = {g['id']: g for g in all_gear if g['id'].startswith('g')}
-
-    # Prepare stats for each shoe
-    shoe_stats = {}
-    for shoe_id, shoe in shoes.items():
-        shoe_stats[shoe_id] = {
-            "name": shoe.get("name", "Unknown"),
-            "retired": shoe.get("retired", False),
-            "longest_run": 0,
-            "total_distance": 0,
-            "total_elevation_gain": 0,
-            "activity_count": 0,
-            "average_run_length": 0,
-            "total_time": 0,
-            "average_pace": 0,
-            "first_use": None  
-        }
+    gear = {g['id']: g for g in all_gear if g['id'].startswith(prefix)}
+    totals = load_gear_totals(activities_path, gear_ids=gear)
 
-    # Aggregate activity data by shoe
-    for activity in activities:
-        gear_id = activity.get("gear_id")
-        if gear_id in shoe_stats:
-            dist = activity.get("distance", 0)
-            elev = activity.get("total_elevation_gain", 0)
-            time = activity.get("moving_time", 0)
-            date_str = activity.get("start_date_local", activity.get("start_date"))
-            try:
-                date_obj = datetime.strptime(date_str[:19], "%Y-%m-%dT%H:%M:%S")
-            except Exception:
-                date_obj = None
-            shoe_stats[gear_id]["total_distance"] += dist
-            shoe_stats[gear_id]["total_elevation_gain"] += elev
-            shoe_stats[gear_id]["longest_run"] = max(shoe_stats[gear_id]["longest_run"], dist)
-            shoe_stats[gear_id]["activity_count"] += 1
-            shoe_stats[gear_id]["total_time"] += time
-            # Track first use
-            if date_obj:
-                if shoe_stats[gear_id]["first_use"] is None or date_obj < shoe_stats[gear_id]["first_use"]:
-                    shoe_stats[gear_id]["first_use"] = date_obj
-
-    # Calculate average run length and average pace for each shoe
-    for stats in shoe_stats.values():
-        if stats["activity_count"] > 0:
-            stats["average_run_length"] = stats["total_distance"] / stats["activity_count"]
+    stats = []
+    for gear_id, g in gear.items():
+        s = dict(totals.get(gear_id) or empty_gear_totals())
+        s["id"] = gear_id
+        s["name"] = g.get("name", "Unknown")
+        s["retired"] = g.get("retired", False)
+        # Parse only the earliest date per gear, not one per activity
+        try:
+            s["first_use"] = datetime.strptime(s["first_use"][:19], "%Y-%m-%dT%H:%M:%S")
+        except Exception:
+            s["first_use"] = None
+        s["average_length"] = s["total_distance"] / s["activity_count"] if s["activity_count"] > 0 else 0
+        # Average pace (min/km) for shoes, average speed (km/h) for bikes
+        if s["total_distance"] > 0:
+            s["average_pace"] = (s["total_time"] / 60) / (s["total_distance"] / 1000)
         else:
-            stats["average_run_length"] = 0
-        if stats["total_distance"] > 0:
-            stats["average_pace"] = (stats["total_time"] / 60) / (stats["total_distance"] / 1000)
+            s["average_pace"] = 0
+        if s["total_time"] > 0:
+            s["average_speed"] = (s["total_distance"] / 1000) / (s["total_time"] / 3600)
         else:
-            stats["average_pace"] = 0
+            s["average_speed"] = 0
+        stats.append(s)
+    return stats
+
+SHOE_COLUMNS = [
+    Column("name", "Shoe", "Shoe", 30),
+    Column("retired", "Retired", "Retired", 8),
+    Column("activity_count", "Runs", "Runs", 5, digits=0),
+    Column("first_use", "First Use", "First Use", 10),
+    Column("longest", "Longest Run (km)", "Longest(km)", 12, digits=1, console_digits=2),
+    Column("total_distance", "Total Distance (km)", "Total Dist(km)", 15, digits=1, console_digits=2),
+    Column("total_elevation_gain", "Total Elevation Gain (km)", "Total Elev(km)", 15, digits=1, console_digits=2),
+    Column("average_length", "Average Run Length (km)", "Avg Run(km)", 12, digits=1, console_digits=2),
+    Column("total_time", "Total Time (h)", "Tot Time(h)", 12, digits=0, console_digits=2),
+    Column("average_pace", "Average Pace (min/km)", "Avg Pace", 10),
+]
+
+BIKE_COLUMNS = [
+    Column("name", "Bike", "Bike", 30),
+    Column("retired", "Retired", "Retired", 8),
+    Column("activity_count", "Rides", "Rides", 5, digits=0),
+    Column("longest", "Longest Ride (km)", "Longest(km)", 12, digits=1, console_digits=2),
+    Column("total_distance", "Total Distance (km)", "Total Dist(km)", 15, digits=1, console_digits=2),
+    Column("total_elevation_gain", "Total Elevation Gain (km)", "Total Elev(km)", 15, digits=1, console_digits=2),
+    Column("average_length", "Average Ride Length (km)", "Avg Ride(km)", 12, digits=1, console_digits=2),
+    Column("total_time", "Total Time (h)", "Tot Time(h)", 12, digits=0, console_digits=2),
+    Column("average_speed", "Average Speed (km/h)", "Avg Speed", 10, digits=1, console_digits=2),
+]
+
+def league_row(s):
+    # One gear_stats entry in display units, shared by every output format
+    return {
+        "name": s["name"],
+        "retired": "Yes" if s.get("retired") else "No",
+        "activity_count": s["activity_count"],
+        "longest": s["longest"] / 1000,
+        "total_distance": s["total_distance"] / 1000,
+        "total_elevation_gain": s["total_elevation_gain"] / 1000,
+        "average_length": s["average_length"] / 1000,
+        "total_time": s["total_time"] / 3600,
+    }
+
+def save_league_table(table, output_csv, formats):
+    written = write_league_table(table, output_csv, formats)
+    changed = [path for path, was_written in written.items() if was_written]
+    if changed:
+        print(f"\nLeague table saved to {', '.join(changed)}")
+    else:
+        print(f"\nLeague table unchanged: {output_csv}")
+    return written
+
+def combine_shoes(all_gear_path, activities_path, output_csv, formats=LEAGUE_FORMATS):
+    # Filter only shoes from all_gear (IDs starting with 'g')
+    rows = []
+    for s in gear_stats(all_gear_path, activities_path, 'g'):
+        row = league_row(s)
         # Format first use as 'Mon YYYY'
-        if stats["first_use"]:
-            stats["first_use_str"] = stats["first_use"].strftime("%b %Y")
-        else:
-            stats["first_use_str"] = "-"
+        row["first_use"] = s["first_use"].strftime("%b %Y") if s["first_use"] else "-"
+        pace = s["average_pace"]
+        row["average_pace"] = f"{int(pace):02d}:{int((pace % 1) * 60):02d}" if pace > 0 else "-"
+        rows.append(row)
 
     # Create league table sorted by total_distance (descending)
-    league = sorted(shoe_stats.values(), key=lambda x: x["total_distance"], reverse=True)
-
-    # Print league table
-    print(f"{'Shoe':30} {'Retired':>8} {'Runs':>5} {'First Use':>10} {'Longest(km)':>12} {'Total Dist(km)':>15} {'Total Elev(km)':>15} {'Avg Run(km)':>12} {'Tot Time(h)':>12} {'Avg Pace':>10}")
-    print("-" * 145)
-    for s in league:
-        avg_pace_str = f"{int(s['average_pace']):02d}:{int((s['average_pace']%1)*60):02d}" if s['average_pace'] > 0 else "-"
-        retired_str = "Yes" if s.get('retired') else "No"
-        print(f"{s['name'][:30]:30} {retired_str:>8} {s['activity_count']:5} {s['first_use_str']:>10} {s['longest_run']/1000:12.2f} {s['total_distance']/1000:15.2f} {s['total_elevation_gain']/1000:15.2f} {s['average_run_length']/1000:12.2f} {s['total_time']/3600:12.2f} {avg_pace_str:>10}")
-
-    # Optionally, save league table to CSV
-    import csv
-    with open(output_csv, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            "Shoe", "Retired", "Runs", "First Use", "Longest Run (km)", "Total Distance (km)", "Total Elevation Gain (km)",
-            "Average Run Length (km)", "Total Time (h)", "Average Pace (min/km)"
-        ])
-        for s in league:
-            avg_pace_str = f"{int(s['average_pace']):02d}:{int((s['average_pace']%1)*60):02d}" if s['average_pace'] > 0 else "-"
-            retired_str = "Yes" if s.get('retired') else "No"
-            writer.writerow([
-                s['name'],
-                retired_str,
-                s['activity_count'],
-                s['first_use_str'],
-                round(s['longest_run']/1000, 1),
-                round(s['total_distance']/1000, 1),
-                round(s['total_elevation_gain']/1000, 1),
-                round(s['average_run_length']/1000, 1),
-                round(s['total_time']/3600),
-                avg_pace_str
-            ])
-    print(f"\nLeague table saved to {output_csv}")
-    pass
-
-def combine_bikes(all_gear_path, activities_path, output_csv):
-    # Load data
-    with open(all_gear_path, "r") as f:
-        all_gear = json.load(f)
-    with open(activities_path, "r") as f:
-        activities = json.load(f)
+    rows.sort(key=lambda r: r["total_distance"], reverse=True)
+    table = LeagueTable("Shoe league table", SHOE_COLUMNS, rows, rule_width=145)
+    print_table(table)
+    return save_league_table(table, output_csv, formats)
 
+def combine_bikes(all_gear_path, activities_path, output_csv, formats=LEAGUE_FORMATS):
     # Filter only bikes from all_gear (IDs starting with 'b')
-    bikes = {g['id']: g for g in all_gear if g['id'].startswith('b')}
-
-    # Prepare stats for each bike
-    bike_stats = {}
-    for bike_id, bike in bikes.items():
-        bike_stats[bike_id] = {
-            "name": bike.get("name", "Unknown"),
-            "retired": bike.get("retired", False),  
-            "longest_ride": 0,
-            "total_distance": 0,
-            "total_elevation_gain": 0,
-            "activity_count": 0,
-            "average_ride_length": 0,
-            "total_time": 0,
-            "average_speed": 0
-        }
-
-    # Aggregate activity data by bike
-    for activity in activities:
-        gear_id = activity.get("gear_id")
-        if gear_id in bike_stats:
-            dist = activity.get("distance", 0)
-            elev = activity.get("total_elevation_gain", 0)
-            time = activity.get("moving_time", 0)  
-            bike_stats[gear_id]["total_distance"] += dist
-            bike_stats[gear_id]["total_elevation_gain"] += elev
-            bike_stats[gear_id]["longest_ride"] = max(bike_stats[gear_id]["longest_ride"], dist)
-            bike_stats[gear_id]["activity_count"] += 1
-            bike_stats[gear_id]["total_time"] += time
-
-    # Calculate average ride length and average speed for each bike
-    for stats in bike_stats.values():
-        if stats["activity_count"] > 0:
-            stats["average_ride_length"] = stats["total_distance"] / stats["activity_count"] / 1000  
-        else:
-            stats["average_ride_length"] = 0
-        # Calculate average speed (km/h)
-        if stats["total_time"] > 0:
-            stats["average_speed"] = (stats["total_distance"] / 1000) / (stats["total_time"] / 3600)
-        else:
-            stats["average_speed"] = 0
+    stats = gear_stats(all_gear_path, activities_path, 'b')
+    rows = []
+    for s in stats:
+        row = league_row(s)
+        # Unused bikes keep the integer 0 the bike table has always written
+        if s["activity_count"] == 0:
+            row["average_length"] = 0
+        row["average_speed"] = s["average_speed"]
+        rows.append(row)
 
-    # Create league table sorted by average_ride_length
-    league = sorted(bike_stats.values(), key=lambda x: x["average_ride_length"], reverse=True)
+    # Create league table sorted by average ride length
+    rows.sort(key=lambda r: r["average_length"], reverse=True)
 
-    # Calculate totals
+    # Calculate totals from the raw stats, in metres and seconds
+    count = sum(s["activity_count"] for s in stats)
+    distance = sum(s["total_distance"] for s in stats)
+    time_s = sum(s["total_time"] for s in stats)
     totals = {
         "name": "TOTAL",
-        "activity_count": sum(s['activity_count'] for s in league),
-        "longest_ride": max(s['longest_ride'] for s in league) if league else 0,
-        "total_distance": sum(s['total_distance'] for s in league),
-        "total_elevation_gain": sum(s['total_elevation_gain'] for s in league),
-        "average_ride_length": sum(s['total_distance'] for s in league) / sum(s['activity_count'] for s in league) / 1000 if sum(s['activity_count'] for s in league) > 0 else 0,
-        "total_time": sum(s['total_time'] for s in league),
-        "average_speed": (sum(s['total_distance'] for s in league) / 1000) / (sum(s['total_time'] for s in league) / 3600) if sum(s['total_time'] for s in league) > 0 else 0
+        "retired": "",
+        "activity_count": count,
+        "longest": (max(s["longest"] for s in stats) if stats else 0) / 1000,
+        "total_distance": distance / 1000,
+        "total_elevation_gain": sum(s["total_elevation_gain"] for s in stats) / 1000,
+        "average_length": distance / count / 1000 if count > 0 else 0,
+        "total_time": time_s / 3600,
+        "average_speed": (distance / 1000) / (time_s / 3600) if time_s > 0 else 0,
     }
+    table = LeagueTable("Bike league table", BIKE_COLUMNS, rows, footer=[totals], rule_width=130)
+    print_table(table)
+    return save_league_table(table, output_csv, formats)
 
-    # Print league table
-    print(f"{'Bike':30} {'Retired':>8} {'Rides':>5} {'Longest(km)':>12} {'Total Dist(km)':>15} {'Total Elev(km)':>15} {'Avg Ride(km)':>12} {'Tot Time(h)':>12} {'Avg Speed':>10}")
-    print("-" * 130)
-    for s in league:
-        retired_str = "Yes" if s.get('retired') else "No"
-        print(f"{s['name'][:30]:30} {retired_str:>8} {s['activity_count']:5} {s['longest_ride']/1000:12.2f} {s['total_distance']/1000:15.2f} {s['total_elevation_gain']/1000:15.2f} {s['average_ride_length']:12.2f} {s['total_time']/3600:12.2f} {s['average_speed']:10.2f}")
-    # Print totals row
-    print("-" * 130)
-    print(f"{'TOTAL':30} {'':>8} {totals['activity_count']:5} {totals['longest_ride']/1000:12.2f} {totals['total_distance']/1000:15.2f} {totals['total_elevation_gain']/1000:15.2f} {totals['average_ride_length']:12.2f} {totals['total_time']/3600:12.2f} {totals['average_speed']:10.2f}")
-
-    # Optionally, save league table to CSV
-    import csv
-    with open(output_csv, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            "Bike", "Retired", "Rides", "Longest Ride (km)", "Total Distance (km)", "Total Elevation Gain (km)",
-            "Average Ride Length (km)", "Total Time (h)", "Average Speed (km/h)"
-        ])
-        for s in league:
-            retired_str = "Yes" if s.get('retired') else "No"
-            writer.writerow([
-                s['name'],
-                retired_str,
-                s['activity_count'],
-                round(s['longest_ride']/1000, 1),
-                round(s['total_distance']/1000, 1),
-                round(s['total_elevation_gain']/1000, 1),
-                round(s['average_ride_length'], 1),
-                round(s['total_time']/3600),  # Nearest hour
-                round(s['average_speed'], 1)
-            ])
-        # Write totals row
-        writer.writerow([
-            'TOTAL',
-            '',
-            totals['activity_count'],
-            round(totals['longest_ride']/1000, 1),
-            round(totals['total_distance']/1000, 1),
-            round(totals['total_elevation_gain']/1000, 1),
-            round(totals['average_ride_length'], 1),
-            round(totals['total_time']/3600),  # Nearest hour
-            round(totals['average_speed'], 1)
-        ])
-    print(f"\nLeague table saved to {output_csv}")
-    pass
+def verify_aggregates(db_path, repair=True):
+    # Full-recompute check of the gear totals maintained as activities arrive
+    conn = open_store(db_path)
+    mismatches = verify_gear_totals(conn)
+    if not mismatches:
+        print("Gear totals match a full recompute.")
+    else:
+        for gear_id, field, stored, expected in mismatches:
+            print(f"Gear {gear_id}: {field} is {stored}, full recompute gives {expected}")
+        if repair:
+            rebuild_gear_totals(conn)
+            print("Gear totals rebuilt from activities.")
+    conn.close()
+    return not mismatches
 
 def refresh_access_token(client_id, client_secret, refresh_token):
+    import requests
     response = requests.post(
-        url="https://www.strava.com/oauth/token",
+        url=STRAVA_OAUTH_URL,
         data={
             "client_id": client_id,
             "client_secret": client_secret,
@@ -335,15 +671,15 @@ def refresh_access_token(client_id, client_secret, refresh_token):
         }
     )
     tokens = response.json()
-    print("Tokens response from Strava:\n", json.dumps(tokens, indent=2))  # <-- Add this line
     if "access_token" in tokens and "refresh_token" in tokens and "expires_at" in tokens:
         return tokens["access_token"], tokens["refresh_token"], tokens["expires_at"]
     else:
         raise Exception(f"Failed to refresh token: {tokens}")
 
 def exchange_code_for_tokens(client_id, client_secret, code):
+    import requests
     response = requests.post(
-        url='https://www.strava.com/oauth/token',
+        url=STRAVA_OAUTH_URL,
         data={
             'client_id': client_id,
             'client_secret': client_secret,
@@ -355,51 +691,140 @@ def exchange_code_for_tokens(client_id, client_secret, code):
     if 'access_token' in tokens and 'refresh_token' in tokens and 'expires_at' in tokens:
         print("Access Token:", tokens['access_token'])
         print("Refresh Token:", tokens['refresh_token'])
-        # Directly update .env file
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        env_path = os.path.join(script_dir, ".env")
-        # Read current .env
-        if os.path.exists(env_path):
-            with open(env_path, "r") as f:
-                lines = f.readlines()
-        else:
-            lines = []
-        # Prepare new lines, replacing or removing as needed
-        new_lines = []
-        found_access = found_refresh = found_expiry = False
-        for line in lines:
-            if line.startswith("STRAVA_ACCESS_TOKEN="):
-                new_lines.append(f"STRAVA_ACCESS_TOKEN={tokens['access_token']}\n")
-                found_access = True
-            elif line.startswith("STRAVA_REFRESH_TOKEN="):
-                new_lines.append(f"STRAVA_REFRESH_TOKEN={tokens['refresh_token']}\n")
-                found_refresh = True
-            elif line.startswith("STRAVA_EXPIRES_AT="):
-                new_lines.append(f"STRAVA_EXPIRES_AT={tokens['expires_at']}\n")
-                found_expiry = True
-            elif line.startswith("AUTHORIZATION_CODE="):
-                continue
-            else:
-                new_lines.append(line)
-        if not found_access:
-            new_lines.append(f"STRAVA_ACCESS_TOKEN={tokens['access_token']}\n")
-        if not found_refresh:
-            new_lines.append(f"STRAVA_REFRESH_TOKEN={tokens['refresh_token']}\n")
-        if not found_expiry:
-            new_lines.append(f"STRAVA_EXPIRES_AT={tokens['expires_at']}\n")
-        # Write back to .env
-        with open(env_path, "w") as f:
-            f.writelines(new_lines)
+        # Directly update .env file (atomically, under its lock)
+        store = EnvFileTokenStore(default_env_path())
+        with store.lock():
+            store.write(tokens)
         print(".env file updated with new tokens and expiry.")
         return tokens['access_token'], tokens['refresh_token'], tokens['expires_at']
     else:
         print("Error exchanging code:", tokens)
         return None, None, None
 
-# Usage (first time only)
-client_id = os.getenv('CLIENT_ID')
-client_secret = os.getenv('CLIENT_SECRET')
-authorization_code = os.getenv('AUTHORIZATION_CODE')
-if authorization_code:
-    access_token, refresh_token = exchange_code_for_tokens(client_id, client_secret, authorization_code)
-    # Save tokens and remove AUTHORIZATION_CODE from .env after first use
\ No newline at end of file
+def default_env_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+
+class EnvFileTokenStore:
+    # Token persistence in a .env file. Writes go to a temp file that is
+    # renamed over .env, and read-refresh-write runs under an exclusive lock
+    # on .env.lock, so concurrent runs never corrupt it or refresh twice.
+    KEYS = {"access_token": "STRAVA_ACCESS_TOKEN", "refresh_token": "STRAVA_REFRESH_TOKEN",
+            "expires_at": "STRAVA_EXPIRES_AT"}
+
+    def __init__(self, env_path):
+        self.env_path = env_path
+
+    @contextmanager
+    def lock(self):
+        with open(self.env_path + ".lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_lines(self):
+        if os.path.exists(self.env_path):
+            with open(self.env_path, "r") as f:
+                return f.readlines()
+        return []
+
+    def read(self):
+        values = {}
+        for line in self.read_lines():
+            for key, env_key in self.KEYS.items():
+                if line.startswith(env_key + "="):
+                    values[key] = line.split("=", 1)[1].strip()
+        if "expires_at" in values:
+            values["expires_at"] = int(values["expires_at"])
+        return values
+
+    def write(self, tokens):
+        # Replace the token lines (adding any that are missing), drop the
+        # one-time AUTHORIZATION_CODE, and keep everything else as it was
+        new_lines = []
+        found = set()
+        for line in self.read_lines():
+            key = next((k for k, env_key in self.KEYS.items() if line.startswith(env_key + "=")), None)
+            if key:
+                new_lines.append(f"{self.KEYS[key]}={tokens[key]}\n")
+                found.add(key)
+            elif line.startswith("AUTHORIZATION_CODE="):
+                continue
+            else:
+                new_lines.append(line if line.endswith("\n") else line + "\n")
+        for key, env_key in self.KEYS.items():
+            if key not in found:
+                new_lines.append(f"{env_key}={tokens[key]}\n")
+        tmp_path = self.env_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(new_lines)
+        if os.path.exists(self.env_path):
+            shutil.copymode(self.env_path, tmp_path)
+        os.replace(tmp_path, self.env_path)
+
+class TokenManager:
+    # Keeps one athlete's access token in memory and refreshes it shortly
+    # before expires_at, or straight away after a 401. Refreshes are
+    # serialised per process (self.lock) and, with a store, across processes
+    # (store.lock()); whoever gets the lock second adopts the new tokens
+    # instead of refreshing again.
+    def __init__(self, client_id, client_secret, access_token=None, refresh_token=None,
+                 expires_at=None, store=None, margin=TOKEN_REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = int(expires_at) if expires_at else 0
+        self.store = store
+        self.margin = margin
+        self.lock = threading.Lock()
+
+    def is_fresh(self, access_token, expires_at):
+        return bool(access_token) and int(expires_at or 0) - self.margin > time.time()
+
+    def token(self):
+        with self.lock:
+            if not self.is_fresh(self.access_token, self.expires_at):
+                self._refresh(stale_token=self.access_token)
+            return self.access_token
+
+    def refresh_after_401(self, failed_token):
+        # Another thread may already have replaced the token that failed
+        with self.lock:
+            if self.access_token == failed_token:
+                self._refresh(stale_token=failed_token)
+            return self.access_token
+
+    def set_tokens(self, tokens):
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"]
+        self.expires_at = int(tokens["expires_at"])
+
+    def _refresh(self, stale_token):
+        if not self.store:
+            self._refresh_from_strava()
+            return
+        with self.store.lock():
+            saved = self.store.read()
+            if saved.get("access_token") != stale_token and self.is_fresh(
+                    saved.get("access_token"), saved.get("expires_at")):
+                print("Using access token refreshed by another run.")
+                self.set_tokens(saved)
+                return
+            if saved.get("refresh_token"):
+                # Refresh tokens rotate; the saved one is the newest
+                self.refresh_token = saved["refresh_token"]
+            self._refresh_from_strava()
+            self.store.write({"access_token": self.access_token, "refresh_token": self.refresh_token,
+                              "expires_at": self.expires_at})
+
+    def _refresh_from_strava(self):
+        if not self.refresh_token:
+            raise Exception("No refresh token found. Please authorize the app with Strava.")
+        print("Access token expired or expiring, refreshing using refresh token...")
+        access_token, refresh_token, expires_at = refresh_access_token(
+            self.client_id, self.client_secret, self.refresh_token)
+        self.set_tokens({"access_token": access_token, "refresh_token": refresh_token, "expires_at": expires_at})
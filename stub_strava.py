@@ -0,0 +1,222 @@
+import json
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Minimal local stand-in for the Strava API, used by bench_strava.py.
+# Serves /athlete/activities, /activities/{id}, /activities/{id}/streams and
+# /gear/{id} from in-memory data with an
+# artificial per-request latency so network-bound code can be timed offline.
+# Optionally simulates Strava's rate limits (short_limit requests per window,
+# daily_limit per run) with the same X-RateLimit-* headers and 429 responses,
+# and fails a fraction of requests with a 5xx. With require_auth set, only
+# tokens issued by its /oauth/token endpoint are accepted. Responses carry an
+# ETag and If-None-Match gets a 304.
+
+
+class StubStrava:
+    def __init__(self, activities=None, gear=None, latency=0.05,
+                 short_limit=None, daily_limit=None, window=900, error_rate=0.0):
+        self.activities = activities or []
+        self.gear = {g['id']: g for g in (gear or [])}
+        self.latency = latency
+        self.short_limit = short_limit
+        self.daily_limit = daily_limit
+        self.window = window
+        self.error_rate = error_rate
+        self.require_auth = False
+        self.valid_tokens = set()
+        self.token_count = 0
+        self.refresh_count = 0
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.error_count = 0
+        self.not_modified_count = 0
+        self.window_start = 0
+        self.short_usage = 0
+        self.daily_usage = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/api/v3"
+
+    @property
+    def oauth_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/oauth/token"
+
+    def issue_tokens(self, expires_in=21600):
+        with self.lock:
+            self.token_count += 1
+            access_token = f"access-{self.token_count}"
+            self.valid_tokens.add(access_token)
+            return {"token_type": "Bearer", "access_token": access_token,
+                    "refresh_token": f"refresh-{self.token_count}",
+                    "expires_at": int(time.time()) + expires_in, "expires_in": expires_in}
+
+    def revoke_tokens(self):
+        with self.lock:
+            self.valid_tokens.clear()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_daily_usage(self):
+        with self.lock:
+            self.daily_usage = 0
+
+    def count_request(self):
+        # Returns (status override or None, rate limit headers)
+        with self.lock:
+            self.request_count += 1
+            window_start = time.time() // self.window
+            if window_start != self.window_start:
+                self.window_start = window_start
+                self.short_usage = 0
+            self.short_usage += 1
+            self.daily_usage += 1
+            headers = {}
+            if self.short_limit is not None or self.daily_limit is not None:
+                short_limit = self.short_limit or 10 ** 9
+                daily_limit = self.daily_limit or 10 ** 9
+                headers = {
+                    "X-RateLimit-Limit": f"{short_limit},{daily_limit}",
+                    "X-RateLimit-Usage": f"{self.short_usage},{self.daily_usage}",
+                }
+                if self.short_usage > short_limit or self.daily_usage > daily_limit:
+                    self.rate_limited_count += 1
+                    return 429, headers
+            if self.error_rate and random.random() < self.error_rate:
+                self.error_count += 1
+                return 503, headers
+            return None, headers
+
+    def make_streams(self, activity, query):
+        # 1 Hz synthetic streams, deterministic per activity, in Strava's
+        # key_by_type shape
+        rng = random.Random(activity["id"])
+        n = max(1, int(activity.get("moving_time") or 0))
+        speed = (activity.get("distance") or 0) / n
+        lat, lng, alt = 51.5 + rng.random(), -0.1 - rng.random(), 50 + rng.random() * 100
+        streams = {"time": [], "distance": [], "latlng": [], "altitude": [], "velocity_smooth": [],
+                   "heartrate": [], "cadence": [], "moving": []}
+        for t in range(n):
+            alt += rng.uniform(-0.5, 0.5)
+            lat += rng.uniform(-1, 1) * 1e-5
+            lng += rng.uniform(-1, 1) * 1e-5
+            streams["time"].append(t)
+            streams["distance"].append(round(speed * t, 1))
+            streams["latlng"].append([round(lat, 6), round(lng, 6)])
+            streams["altitude"].append(round(alt, 1))
+            streams["velocity_smooth"].append(round(speed + rng.uniform(-0.3, 0.3), 2))
+            streams["heartrate"].append(rng.randint(120, 175))
+            streams["cadence"].append(rng.randint(80, 92))
+            streams["moving"].append(True)
+        keys = query.get("keys", [",".join(streams)])[0].split(",")
+        return {k: {"data": v, "series_type": "distance", "original_size": n, "resolution": "high"}
+                for k, v in streams.items() if k in keys}
+
+    def handle_get(self, path, query):
+        if path == "/api/v3/athlete/activities":
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            after = query.get("after")
+            before = query.get("before")
+            selected = self.activities
+            if after:
+                selected = [a for a in selected if a["_epoch"] > int(after[0])]
+            if before:
+                selected = [a for a in selected if a["_epoch"] < int(before[0])]
+            start = (page - 1) * per_page
+            body = [{k: v for k, v in a.items() if k != "_epoch"} for a in selected[start:start + per_page]]
+            return 200, body
+        if path.startswith("/api/v3/activities/") and path.endswith("/streams"):
+            aid = int(path.split("/")[-2])
+            for a in self.activities:
+                if a["id"] == aid and not a.get("manual"):
+                    return 200, self.make_streams(a, query)
+            return 404, {"message": "Record Not Found", "errors": [{"resource": "Activity", "code": "not found"}]}
+        if path.startswith("/api/v3/activities/"):
+            aid = int(path.rsplit("/", 1)[-1])
+            for a in self.activities:
+                if a["id"] == aid:
+                    return 200, {k: v for k, v in a.items() if k != "_epoch"}
+            return 404, {"message": "Record Not Found", "errors": [{"resource": "Activity", "code": "not found"}]}
+        if path.startswith("/api/v3/gear/"):
+            gid = path.rsplit("/", 1)[-1]
+            if gid in self.gear:
+                return 200, self.gear[gid]
+            return 404, {"message": "Record Not Found", "errors": [{"resource": "Gear", "code": "not found"}]}
+        return 404, {"message": "Not Found"}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, status, body, headers=None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if urlparse(self.path).path != "/oauth/token":
+                    self.send_json(404, {"message": "Not Found"})
+                    return
+                with stub.lock:
+                    stub.refresh_count += 1
+                self.send_json(200, stub.issue_tokens())
+
+            def do_GET(self):
+                override, headers = stub.count_request()
+                time.sleep(stub.latency)
+                token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+                if stub.require_auth and token not in stub.valid_tokens:
+                    status, body = 401, {"message": "Authorization Error", "errors": [{"resource": "Athlete", "code": "invalid"}]}
+                elif override == 429:
+                    status, body = 429, {"message": "Rate Limit Exceeded", "errors": [{"resource": "Application", "code": "exceeded"}]}
+                elif override:
+                    status, body = override, {"message": "Service Unavailable"}
+                else:
+                    parsed = urlparse(self.path)
+                    status, body = stub.handle_get(parsed.path, parse_qs(parsed.query))
+                if status == 200:
+                    # Weak ETag over the body, as Strava sends
+                    etag = f'W/"{hashlib.md5(json.dumps(body).encode()).hexdigest()}"'
+                    headers = dict(headers, ETag=etag)
+                    if self.headers.get("If-None-Match") == etag:
+                        with stub.lock:
+                            stub.not_modified_count += 1
+                        self.send_response(304)
+                        for name, value in headers.items():
+                            self.send_header(name, value)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                self.send_json(status, body, headers)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
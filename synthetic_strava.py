@@ -0,0 +1,90 @@
+import os
+import json
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+# Strava-shaped synthetic athletes for offline runs and benchmarks: summary
+# activities as /athlete/activities returns them, and gear as /gear/{id} does.
+#   python synthetic_strava.py 10k --out synthetic/10k
+#
+# Activities carry an extra "_epoch" (start_date as a Unix time) for
+# stub_strava's after/before filtering; write_dataset drops it.
+
+SCALES = {"1k": 1000, "10k": 10_000, "100k": 100_000}
+HISTORY_END = datetime(2025, 1, 1, tzinfo=timezone.utc)
+HISTORY_START = datetime(2010, 1, 1, tzinfo=timezone.utc)
+
+def scale_count(scale):
+    # "10k" or a plain number
+    return SCALES[scale] if scale in SCALES else int(scale)
+
+def make_gear(count):
+    gear = []
+    for i in range(count):
+        prefix = 'g' if i % 3 else 'b'
+        gear.append({
+            "id": f"{prefix}{1000000 + i}",
+            "name": f"Gear {i}",
+            "retired": i % 5 == 0,
+            "distance": 1000 * i,
+        })
+    return gear
+
+def make_activities(count, gear, seed=0):
+    # One activity every ~11 hours going back from HISTORY_END, closer
+    # together for large counts so the history stays after HISTORY_START
+    rng = random.Random(seed)
+    hours_apart = min(11, (HISTORY_END - HISTORY_START).total_seconds() / 3600 / max(count, 1))
+    activities = []
+    for i in range(count):
+        dt = HISTORY_END - timedelta(hours=hours_apart * i)
+        g = rng.choice(gear)
+        ride = g['id'].startswith('b')
+        distance = rng.uniform(3000, 80000 if ride else 25000)
+        moving_time = rng.randint(900, 14000)
+        activities.append({
+            "id": 10_000_000 + i,
+            "_epoch": int(dt.timestamp()),
+            "resource_state": 2,
+            "athlete": {"id": 1, "resource_state": 1},
+            "name": f"Activity {i}",
+            "type": "Ride" if ride else "Run",
+            "sport_type": "Ride" if ride else "Run",
+            "start_date": dt.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "start_date_local": (dt + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "timezone": "(GMT+00:00) Europe/London",
+            "gear_id": g['id'],
+            "distance": distance,
+            "moving_time": moving_time,
+            "elapsed_time": moving_time + rng.randint(0, 600),
+            "total_elevation_gain": rng.uniform(0, 900),
+            "average_speed": distance / moving_time,
+            "manual": False,
+            "commute": rng.random() < 0.1,
+            "kudos_count": rng.randint(0, 30),
+            "map": {"id": f"a{i}", "summary_polyline": "abc" * 40},
+        })
+    return activities
+
+def write_dataset(out_dir, count, gear_count=40, seed=0):
+    # activities.json and all_gear.json in the layout run_strava.py uses
+    os.makedirs(out_dir, exist_ok=True)
+    gear = make_gear(gear_count)
+    activities = make_activities(count, gear, seed)
+    for a in activities:
+        del a["_epoch"]
+    with open(os.path.join(out_dir, "activities.json"), "w") as f:
+        json.dump(activities, f, indent=2)
+    with open(os.path.join(out_dir, "all_gear.json"), "w") as f:
+        json.dump(gear, f, indent=2)
+    print(f"Wrote {count} activities and {gear_count} gear to {out_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic Strava athlete")
+    parser.add_argument("scale", help=f"one of {', '.join(SCALES)} or a number of activities")
+    parser.add_argument("--out", default="synthetic")
+    parser.add_argument("--gear", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_dataset(args.out, scale_count(args.scale), args.gear, args.seed)
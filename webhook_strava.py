@@ -0,0 +1,175 @@
+import os
+import json
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from strava_tools import (
+    api_get, extract_gear_ids_from_activities, fetch_gear_details, combine_shoes, combine_bikes,
+    sync_manifest_path, StravaClient, StravaAPIError
+)
+from activity_store import open_store, insert_activities, delete_activities
+from http_cache import HttpCache
+
+# Push-based ingestion: a Strava webhook subscription callback. Strava sends
+# one small event per activity create/update/delete; each is queued, and a
+# worker fetches only that activity (plus any gear not seen before), patches
+# the store, and re-renders the league tables from the maintained totals.
+#   python webhook_strava.py --port 8080 --verify-token SECRET --record events.jsonl
+#   python webhook_strava.py --replay events.jsonl
+#
+# Subscribe with a POST to https://www.strava.com/api/v3/push_subscriptions
+# with callback_url pointing at this service and the same verify_token.
+
+WEBHOOK_PATH = "/webhook"
+EVENT_BATCH_SIZE = 50
+
+class EventProcessor:
+    def __init__(self, data_dir, client=None):
+        self.activities_path = os.path.join(data_dir, "activities.db")
+        self.gear_ids_path = os.path.join(data_dir, "gear_ids.json")
+        self.all_gear_path = os.path.join(data_dir, "all_gear.json")
+        self.shoes_csv = os.path.join(data_dir, "shoe_league_table.csv")
+        self.bikes_csv = os.path.join(data_dir, "bike_league_table.csv")
+        self.client = client
+        self.events = queue.Queue()
+
+    def process(self, events):
+        # Coalesce a batch: only the last event per activity matters
+        latest = {}
+        for event in events:
+            if event.get("object_type") == "athlete":
+                if event.get("updates", {}).get("authorized") == "false":
+                    print(f"Athlete {event.get('owner_id')} revoked access.")
+                continue
+            if event.get("object_type") == "activity":
+                latest[event["object_id"]] = event["aspect_type"]
+        if not latest:
+            return
+        # Until a polling sync has written its manifest, the store may be
+        # missing the history; patching it would make the first sync take the
+        # pushed activities as its high-water mark and skip the backfill. That
+        # sync downloads everything these events describe anyway.
+        if not os.path.exists(sync_manifest_path(self.activities_path)):
+            print(f"Skipping {len(latest)} webhook events: run run_strava.py once to download the history first.")
+            return
+
+        conn = open_store(self.activities_path)
+        try:
+            deleted = [aid for aid, aspect in latest.items() if aspect == "delete"]
+            fetched = []
+            for aid, aspect in latest.items():
+                if aspect == "delete":
+                    continue
+                try:
+                    # The event says it changed, so don't trust a cached copy
+                    fetched.append(api_get(f"/activities/{aid}", client=self.client, revalidate=True))
+                except StravaAPIError as e:
+                    # Deleted or made private since the event was sent
+                    if e.status_code not in (403, 404):
+                        raise
+                    deleted.append(aid)
+            added = insert_activities(conn, fetched)
+            removed = delete_activities(conn, deleted)
+        finally:
+            conn.close()
+        print(f"Webhook batch: {added} added, {len(fetched) - added} updated, {removed} deleted.")
+
+        # Gear already in gear_cache.json is never refetched here
+        extract_gear_ids_from_activities(self.activities_path, self.gear_ids_path)
+        fetch_gear_details(self.gear_ids_path, self.all_gear_path, cache_ttl=float("inf"), client=self.client)
+        combine_shoes(self.all_gear_path, self.activities_path, self.shoes_csv)
+        combine_bikes(self.all_gear_path, self.activities_path, self.bikes_csv)
+
+    def run(self):
+        # Worker loop: block for one event, then take whatever else is queued
+        while True:
+            events = [self.events.get()]
+            while len(events) < EVENT_BATCH_SIZE:
+                try:
+                    events.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.process(events)
+            except Exception as e:
+                print(f"Failed to process {len(events)} webhook events: {e}")
+
+def make_handler(processor, verify_token, record_path=None):
+    record_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            # Subscription validation handshake
+            parsed = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            if (parsed.path == WEBHOOK_PATH and query.get("hub.mode") == "subscribe"
+                    and query.get("hub.verify_token") == verify_token and "hub.challenge" in query):
+                self.send_json(200, {"hub.challenge": query["hub.challenge"]})
+            else:
+                self.send_json(403, {"message": "Forbidden"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != WEBHOOK_PATH:
+                self.send_json(404, {"message": "Not Found"})
+                return
+            try:
+                event = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self.send_json(400, {"message": "Invalid JSON"})
+                return
+            # Strava expects a 200 within two seconds, so only queue here
+            if record_path:
+                with record_lock, open(record_path, "a") as f:
+                    f.write(json.dumps(event) + "\n")
+            processor.events.put(event)
+            self.send_json(200, {})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+def replay(processor, events_path):
+    # Feed recorded event payloads (one JSON object per line) through the
+    # same processing as live events
+    with open(events_path, "r") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    for i in range(0, len(events), EVENT_BATCH_SIZE):
+        processor.process(events[i:i + EVENT_BATCH_SIZE])
+    print(f"Replayed {len(events)} events from {events_path}")
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Strava webhook listener")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--verify-token",
+                        help="must match the verify_token used to create the subscription "
+                             "(default: STRAVA_VERIFY_TOKEN)")
+    parser.add_argument("--record", help="append every received event to this JSON-lines file")
+    parser.add_argument("--replay", help="process recorded events from this JSON-lines file and exit")
+    args = parser.parse_args()
+
+    client = StravaClient.from_env(os.path.join(script_dir, ".env"),
+                                   cache=HttpCache(os.path.join(script_dir, "http_cache.db")))
+    processor = EventProcessor(script_dir, client)
+    if args.replay:
+        replay(processor, args.replay)
+    else:
+        verify_token = args.verify_token or os.getenv("STRAVA_VERIFY_TOKEN")
+        if not verify_token:
+            raise Exception("Set --verify-token or STRAVA_VERIFY_TOKEN.")
+        threading.Thread(target=processor.run, daemon=True).start()
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(processor, verify_token, args.record))
+        print(f"Listening for Strava events on {args.host}:{args.port}{WEBHOOK_PATH}")
+        server.serve_forever()